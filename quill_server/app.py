@@ -3,15 +3,36 @@ from collections.abc import AsyncGenerator
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
 from quill_server import cache
+from quill_server.auth import sessions, users
+from quill_server.auth.hashing import hasher
+from quill_server.metrics import CONTENT_TYPE, registry
 from quill_server.schema import MessageResponse
+from quill_server.realtime.lifecycle import sweeper
+from quill_server.realtime.outbox import outboxes
+from quill_server.realtime.pubsub import hub
+from quill_server.realtime.scheduler import scheduler
+from quill_server.realtime.words import word_bank
 from quill_server.routers import user, room
 
 
 @asynccontextmanager
 async def lifetime(app: FastAPI) -> AsyncGenerator[None, None]:
+    await sessions.start()
+    await users.start()
+    await word_bank.start()
+    await scheduler.start()
+    await sweeper.start()
     yield
+    await sweeper.stop()
+    await scheduler.stop()
+    await word_bank.stop()
+    await users.stop()
+    await sessions.stop()
+    await hub.aclose()
+    hasher.shutdown()
     await cache.disconnect()
 
 
@@ -28,7 +49,33 @@ app.add_middleware(
 app.include_router(user.router)
 app.include_router(room.router)
 
+registry.gauge("quill_open_sockets", "Room sockets open on this worker", lambda: len(outboxes))
+registry.gauge(
+    "quill_outbox_max_depth",
+    "Frames queued for the socket furthest behind on this worker",
+    lambda: max((outbox.depth for outbox in outboxes), default=0),
+)
+registry.gauge("quill_rooms", "Rooms with sockets on this worker", lambda: hub.rooms)
+registry.gauge(
+    "quill_turn_engine_rooms",
+    "Rooms whose games this worker runs",
+    lambda: len(scheduler.engine.rooms),
+)
+registry.gauge(
+    "quill_turn_engine_steps",
+    "Rooms this worker's turn engine is advancing",
+    lambda: scheduler.engine.steps,
+)
+registry.gauge(
+    "quill_password_hashes_pending", "Password hashes running or queued", lambda: hasher.pending
+)
+
 
 @app.get("/ping")
 async def ping() -> MessageResponse:
     return MessageResponse(message="Pong!")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(registry.render(), media_type=CONTENT_TYPE)
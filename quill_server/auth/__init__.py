@@ -4,21 +4,32 @@ from uuid import UUID
 from fastapi import HTTPException, WebSocketException, status, Depends
 from fastapi.security import OAuth2PasswordBearer
 from loguru import logger
-from passlib.hash import argon2
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
 
-from quill_server.db.models import User
-from quill_server.schema import TokenResponse
-from quill_server.db.connect import get_db
+from quill_server.schema import TokenResponse, UserInfo
+from quill_server.db.connect import async_session
 from quill_server.cache import client
 from quill_server.config import settings
-from quill_server.auth.store import RedisSessionStorage, InMemorySessionStorage
+from quill_server.realtime.pubsub import hub
+from quill_server.auth.store import (
+    AbstractSessionStorage,
+    RedisSessionStorage,
+    InMemorySessionStorage,
+    SignedTokenSessionStorage,
+)
 from quill_server.auth.session import Session
+from quill_server.auth.hashing import HasherBusyError, hasher
+from quill_server.auth.users import UserCache, track_user_changes
 
 oauth2 = OAuth2PasswordBearer(tokenUrl="user/token")
 
-if settings.USE_REDIS_SESSIONS:
+sessions: AbstractSessionStorage
+
+if settings.USE_SIGNED_SESSIONS:
+    if not settings.SESSION_SECRET_KEY:
+        raise ValueError("SESSION_SECRET_KEY env var is not set")
+    sessions = SignedTokenSessionStorage(redis=client, hub=hub, secret=settings.SESSION_SECRET_KEY)
+    logger.info(f"Using SignedTokenSessionStorage - sessions expire in {sessions.lifespan}")
+elif settings.USE_REDIS_SESSIONS:
     sessions = RedisSessionStorage(redis=client)
     logger.info(f"Using RedisSessionStorage - sessions expire in {sessions.lifespan}")
 else:
@@ -29,9 +40,12 @@ else:
     )
     sessions = InMemorySessionStorage()
 
+users = UserCache(redis=client, hub=hub, db=async_session)
+track_user_changes(users)
+
 
-async def set_session(user_id: UUID, token_type: str = "bearer") -> TokenResponse:
-    session = await sessions.create_session(user_id)
+async def set_session(user_id: UUID, username: str, token_type: str = "bearer") -> TokenResponse:
+    session = await sessions.create_session(user_id, username)
     return TokenResponse(access_token=session.id, token_type=token_type)
 
 
@@ -49,14 +63,18 @@ async def get_current_session_ws(authorization: str) -> Session:
     return session
 
 
-async def get_current_user_ws(
-    session: Session,
-    db: AsyncSession,
-) -> User:
-    stmt = select(User).where(User.id == session.user_id)
-    async with db.begin():
-        user = await db.execute(stmt)
-    return user.scalar_one()
+async def _resolve_user(session: Session) -> UserInfo | None:
+    # sessions that carry the username need no lookup at all
+    if session.username is not None:
+        return UserInfo(id=session.user_id, username=session.username)
+    return await users.get(session.user_id)
+
+
+async def get_current_user_ws(session: Session) -> UserInfo:
+    user = await _resolve_user(session)
+    if not user:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
+    return user
 
 
 async def get_current_session(token: Annotated[str, Depends(oauth2)]) -> Session:
@@ -76,17 +94,34 @@ async def delete_session(_id: str) -> None:
 
 async def get_current_user(
     session: Annotated[Session, Depends(get_current_session)],
-    db: Annotated[AsyncSession, Depends(get_db)],
-) -> User:
-    stmt = select(User).where(User.id == session.user_id)
-    async with db.begin():
-        user = await db.execute(stmt)
-    return user.scalar_one()
+) -> UserInfo:
+    user = await _resolve_user(session)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
 
 
-def hash_password(pw: str) -> str:
-    return argon2.using(rounds=4).hash(pw)
+def _busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please try again shortly",
+        headers={"Retry-After": "1"},
+    )
 
 
-def verify_password(plain: str, hashed: str) -> bool:
-    return argon2.verify(plain, hashed)
+async def hash_password(pw: str) -> str:
+    try:
+        return await hasher.hash(pw)
+    except HasherBusyError:
+        raise _busy() from None
+
+
+async def verify_password(plain: str, hashed: str) -> bool:
+    try:
+        return await hasher.verify(plain, hashed)
+    except HasherBusyError:
+        raise _busy() from None
@@ -0,0 +1,88 @@
+"""Password hashing, run off the event loop."""
+import asyncio
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import TypeVar
+
+from loguru import logger
+from passlib.hash import argon2
+
+from quill_server.config import settings
+from quill_server.errors import AuthError
+from quill_server.metrics import password_hash_seconds
+
+
+T = TypeVar("T")
+
+
+class HasherBusyError(AuthError):
+    """Too many password hashes are already queued."""
+
+
+def _hash(pw: str) -> str:
+    return argon2.using(rounds=4).hash(pw)
+
+
+def _verify(plain: str, hashed: str) -> bool:
+    return argon2.verify(plain, hashed)
+
+
+def _timed(fn: Callable[..., T], *args: str) -> tuple[T, float]:
+    # timed in the pool's thread, so that time spent queued isn't counted, but recorded on
+    # the event loop's thread, which is the only one metrics are updated from
+    start = time.perf_counter()
+    return fn(*args), time.perf_counter() - start
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords in a thread pool.
+
+    Each hash takes tens of milliseconds of CPU, which would freeze every websocket served by
+    the worker if run inline; argon2-cffi releases the GIL while hashing.
+
+    Args:
+        workers: The number of threads hashing passwords.
+        max_pending: The maximum number of hashes that may be running or queued at once.
+    """
+
+    def __init__(self, workers: int, max_pending: int) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="argon2")
+        self.max_pending = max_pending
+        self.pending = 0
+
+    async def _run(self, operation: str, fn: Callable[..., T], *args: str) -> T:
+        if self.pending >= self.max_pending:
+            logger.warning(f"Rejecting password hash; {self.pending} are already queued")
+            raise HasherBusyError("Too many password hashes queued")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result, elapsed = await loop.run_in_executor(self._executor, _timed, fn, *args)
+        finally:
+            self.pending -= 1
+        password_hash_seconds.observe(elapsed, operation)
+        return result
+
+    async def hash(self, pw: str) -> str:  # noqa: A003
+        """Hash a password.
+
+        Raises:
+            HasherBusyError: Too many hashes are already queued.
+        """
+        return await self._run("hash", _hash, pw)
+
+    async def verify(self, plain: str, hashed: str) -> bool:
+        """Check a password against its hash.
+
+        Raises:
+            HasherBusyError: Too many hashes are already queued.
+        """
+        return await self._run("verify", _verify, plain, hashed)
+
+    def shutdown(self) -> None:
+        """Stop the pool, dropping any hashes still waiting for a thread."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+hasher = PasswordHasher(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_MAX_PENDING)
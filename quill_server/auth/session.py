@@ -17,3 +17,5 @@ class Session(BaseModel):
 
     id: str = Field(default_factory=_get_token)  # noqa: A003
     user_id: UUID
+    # only set by storage backends that keep the username in the session
+    username: str | None = None
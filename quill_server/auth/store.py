@@ -1,12 +1,21 @@
+import asyncio
+import contextlib
+import json
+import secrets
+import time
+import typing
 from abc import ABCMeta, abstractmethod
 from datetime import timedelta
 from uuid import UUID
 
+from jose import JWTError, jwt
 from redis.asyncio import Redis
+from redis.exceptions import RedisError
 from loguru import logger
 
 from quill_server.errors import AuthError
 from quill_server.auth.session import Session
+from quill_server.realtime.pubsub import PubSubHub, Subscription
 
 
 class SessionDoesNotExistError(AuthError):
@@ -32,11 +41,12 @@ class AbstractSessionStorage(metaclass=ABCMeta):
         ...
 
     @abstractmethod
-    async def create_session(self, user_id: UUID) -> Session:
+    async def create_session(self, user_id: UUID, username: str | None = None) -> Session:
         """Creates a session for the provided user and stores it.
 
         Args:
             user_id: The user to create the session for.
+            username: The user's username, for backends that keep it in the session.
         Returns:
             The session that was created.
         """
@@ -53,6 +63,12 @@ class AbstractSessionStorage(metaclass=ABCMeta):
         """
         ...
 
+    async def start(self) -> None:  # noqa: B027 - optional hook
+        """Prepares the storage for use. Called once when the app starts."""
+
+    async def stop(self) -> None:  # noqa: B027 - optional hook
+        """Releases any resources held by the storage. Called once when the app shuts down."""
+
 
 class InMemorySessionStorage(AbstractSessionStorage):
     def __init__(self) -> None:
@@ -64,7 +80,7 @@ class InMemorySessionStorage(AbstractSessionStorage):
     async def get_session(self, _id: str) -> Session | None:
         return self._sessions.get(_id)
 
-    async def create_session(self, user_id: UUID) -> Session:
+    async def create_session(self, user_id: UUID, username: str | None = None) -> Session:
         session = Session(user_id=user_id)
         self._sessions[session.id] = session
         return session
@@ -89,7 +105,7 @@ class RedisSessionStorage(AbstractSessionStorage):
         user_id = UUID(bytes=data)
         return Session(id=_id, user_id=user_id)
 
-    async def create_session(self, user_id: UUID) -> Session:
+    async def create_session(self, user_id: UUID, username: str | None = None) -> Session:
         session = Session(user_id=user_id)
         await self.redis.setex(f"session:{session.id}", self.lifespan, session.user_id.bytes)
         logger.info(f"Created session {session.id} with lifespan {self.lifespan}")
@@ -98,3 +114,124 @@ class RedisSessionStorage(AbstractSessionStorage):
     async def delete_session(self, _id: str) -> None:
         await self.redis.delete(f"session:{_id}")
         logger.info(f"Deleted session {id}")
+
+
+class SignedTokenSessionStorage(AbstractSessionStorage):
+    """Stateless sessions.
+
+    The session ID is a signed, expiring JWT carrying the user's ID and username, so
+    validating it needs no I/O. Tokens are revoked by adding their ID to a denylist until
+    they would have expired anyway. The denylist lives in a Redis sorted set scored by
+    expiry, and every worker mirrors it in memory through pub/sub. Revocations published
+    while the pub/sub connection is down are missed, so the denylist is also reloaded every
+    `sync_interval`.
+    """
+
+    _DENYLIST_KEY = "session:denylist"
+    _REVOKED_CHANNEL = "session:revoked"
+
+    def __init__(
+        self,
+        redis: Redis,
+        hub: PubSubHub,
+        secret: str,
+        session_lifespan: timedelta = timedelta(days=1),
+        algorithm: str = "HS256",
+        sync_interval: timedelta = timedelta(seconds=30),
+    ) -> None:
+        self.redis = redis
+        self.hub = hub
+        self.lifespan = session_lifespan
+        self.sync_interval = sync_interval
+        self._secret = secret
+        self._algorithm = algorithm
+        # token ID -> expiry timestamp
+        self._revoked = dict[str, float]()
+        self._stack = contextlib.AsyncExitStack()
+        self._listener: asyncio.Task | None = None
+        self._syncer: asyncio.Task | None = None
+
+    def _decode(self, token: str) -> dict[str, typing.Any] | None:
+        try:
+            return jwt.decode(token, self._secret, algorithms=[self._algorithm])
+        except JWTError:
+            # the token is malformed, forged or expired
+            return None
+
+    def _add_revoked(self, jti: str, exp: float) -> None:
+        now = time.time()
+        if exp > now:
+            self._revoked[jti] = exp
+        # tokens past their expiry are rejected without consulting the denylist,
+        # so their entries can be dropped
+        if len(self._revoked) > 1024:
+            self._revoked = {k: v for k, v in self._revoked.items() if v > now}
+
+    async def get_session(self, _id: str) -> Session | None:
+        claims = self._decode(_id)
+        if claims is None or claims["jti"] in self._revoked:
+            logger.info(f"Session not found for token={_id}")
+            return None
+        return Session(id=_id, user_id=UUID(claims["sub"]), username=claims.get("name"))
+
+    async def create_session(self, user_id: UUID, username: str | None = None) -> Session:
+        now = int(time.time())
+        claims = {
+            "sub": str(user_id),
+            "name": username,
+            "jti": secrets.token_urlsafe(9),
+            "iat": now,
+            "exp": now + int(self.lifespan.total_seconds()),
+        }
+        token = jwt.encode(claims, self._secret, algorithm=self._algorithm)
+        logger.info(f"Created signed session for {user_id} with lifespan {self.lifespan}")
+        return Session(id=token, user_id=user_id, username=username)
+
+    async def delete_session(self, _id: str) -> None:
+        claims = self._decode(_id)
+        if claims is None:
+            # expired tokens are already unusable
+            return
+        jti, exp = claims["jti"], claims["exp"]
+        self._add_revoked(jti, exp)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self._DENYLIST_KEY, {jti: exp})
+            pipe.zremrangebyscore(self._DENYLIST_KEY, "-inf", time.time())
+            pipe.publish(self._REVOKED_CHANNEL, json.dumps({"jti": jti, "exp": exp}))
+            await pipe.execute()
+        logger.info(f"Revoked session {jti}")
+
+    async def _listen(self, revocations: Subscription) -> None:
+        async for message in revocations:
+            self._add_revoked(message.header["jti"], message.header["exp"])
+
+    async def _load_denylist(self) -> None:
+        denylist = await self.redis.zrangebyscore(
+            self._DENYLIST_KEY, time.time(), "+inf", withscores=True
+        )
+        for jti, exp in denylist:
+            self._add_revoked(jti.decode(), exp)
+
+    async def _sync(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_interval.total_seconds())
+            try:
+                await self._load_denylist()
+            except RedisError as e:
+                logger.warning(f"Couldn't reload the session denylist: {e}")
+
+    async def start(self) -> None:
+        # subscribe before loading the denylist, so that no revocation is missed in between
+        revocations = await self._stack.enter_async_context(
+            self.hub.subscribe(self._REVOKED_CHANNEL)
+        )
+        await self._load_denylist()
+        logger.info(f"Loaded {len(self._revoked)} revoked sessions")
+        self._listener = asyncio.create_task(self._listen(revocations))
+        self._syncer = asyncio.create_task(self._sync())
+
+    async def stop(self) -> None:
+        for task in (self._listener, self._syncer):
+            if task is not None:
+                task.cancel()
+        await self._stack.aclose()
@@ -0,0 +1,140 @@
+"""Read-through cache of authenticated users."""
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from uuid import UUID
+
+from loguru import logger
+from redis.asyncio import Redis
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session as DBSession
+from sqlalchemy.orm import object_session
+
+from quill_server.db.models import User
+from quill_server.realtime.pubsub import PubSubHub
+from quill_server.schema import UserInfo
+
+
+class UserCache:
+    """A two tier (in-process LRU, then Redis) read-through cache of users, keyed by ID.
+
+    Postgres is only queried on a miss in both tiers. When a user row is updated or deleted, its
+    entries are dropped from Redis and from every worker's LRU.
+
+    Args:
+        redis: The shared cache tier.
+        hub: Used to tell every worker to drop invalidated users from its LRU.
+        db: Used to load users that aren't cached in either tier.
+        maxsize: The maximum number of users kept in this process.
+        local_ttl: How long a user is kept in this process.
+        shared_ttl: How long a user is kept in Redis.
+    """
+
+    _INVALIDATED_CHANNEL = "user:invalidated"
+
+    def __init__(
+        self,
+        redis: Redis,
+        hub: PubSubHub,
+        db: async_sessionmaker[AsyncSession],
+        maxsize: int = 10_000,
+        local_ttl: timedelta = timedelta(minutes=1),
+        shared_ttl: timedelta = timedelta(minutes=30),
+    ) -> None:
+        self.redis = redis
+        self.hub = hub
+        self.db = db
+        self.maxsize = maxsize
+        self.local_ttl = local_ttl.total_seconds()
+        self.shared_ttl = shared_ttl
+        # user ID -> (expiry timestamp, user)
+        self._local = OrderedDict[UUID, tuple[float, UserInfo]]()
+        self._listener: asyncio.Task | None = None
+        self._pending = set[asyncio.Task]()
+
+    def _get_local(self, user_id: UUID) -> UserInfo | None:
+        entry = self._local.get(user_id)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self._local[user_id]
+            return None
+        self._local.move_to_end(user_id)
+        return user
+
+    def _set_local(self, user: UserInfo) -> None:
+        self._local[user.id] = (time.monotonic() + self.local_ttl, user)
+        self._local.move_to_end(user.id)
+        if len(self._local) > self.maxsize:
+            self._local.popitem(last=False)
+
+    async def _load(self, user_id: UUID) -> UserInfo | None:
+        stmt = select(User.id, User.username).where(User.id == user_id)
+        async with self.db() as db, db.begin():
+            row = (await db.execute(stmt)).one_or_none()
+        if row is None:
+            return None
+        return UserInfo(id=row.id, username=row.username)
+
+    async def get(self, user_id: UUID) -> UserInfo | None:
+        """Get a user by ID, or None if they don't exist."""
+        if user := self._get_local(user_id):
+            return user
+        data = await self.redis.get(f"user:{user_id}")
+        if data is not None:
+            user = UserInfo.model_validate_json(data)
+        else:
+            user = await self._load(user_id)
+            if user is None:
+                return None
+            await self.redis.setex(f"user:{user_id}", self.shared_ttl, user.model_dump_json())
+        self._set_local(user)
+        return user
+
+    async def invalidate(self, user_id: UUID) -> None:
+        """Drop a user from Redis, and from every worker's local tier."""
+        self._local.pop(user_id, None)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(f"user:{user_id}")
+            pipe.publish(self._INVALIDATED_CHANNEL, json.dumps({"user_id": str(user_id)}))
+            await pipe.execute()
+        logger.info(f"Invalidated cached user {user_id}")
+
+    def invalidate_soon(self, user_id: UUID) -> None:
+        """Schedule `invalidate` from synchronous code running on the event loop."""
+        task = asyncio.get_running_loop().create_task(self.invalidate(user_id))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _listen(self) -> None:
+        async with self.hub.subscribe(self._INVALIDATED_CHANNEL) as invalidations:
+            async for message in invalidations:
+                self._local.pop(UUID(message.header["user_id"]), None)
+
+    async def start(self) -> None:
+        """Start listening for users invalidated by other workers."""
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+
+
+def track_user_changes(users: UserCache) -> None:
+    """Invalidate cached users whenever their row is updated or deleted and committed."""
+
+    @event.listens_for(User, "after_update")
+    @event.listens_for(User, "after_delete")
+    def _mark_changed(mapper: object, connection: object, target: User) -> None:
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault("changed_users", set()).add(target.id)
+
+    @event.listens_for(DBSession, "after_commit")
+    def _invalidate_changed(session: DBSession) -> None:
+        for user_id in session.info.pop("changed_users", ()):
+            users.invalidate_soon(user_id)
@@ -1,10 +1,44 @@
+import time
+import typing
+
 from loguru import logger
 import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
+from redis.typing import EncodableT
 
 from quill_server.config import settings
+from quill_server.metrics import redis_command_seconds
+
+
+class _TimedPipeline(Pipeline):
+    """A pipeline whose round trips are timed, as one PIPELINE or MULTI command."""
+
+    async def execute(self, raise_on_error: bool = True) -> list[typing.Any]:
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            command = "MULTI" if self.is_transaction else "PIPELINE"
+            redis_command_seconds.observe(time.perf_counter() - start, command)
+
+
+class TimedRedis(redis.Redis):
+    """A Redis client whose commands are timed (see metrics)."""
+
+    async def execute_command(self, *args: EncodableT, **options: object) -> object:
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            redis_command_seconds.observe(time.perf_counter() - start, args[0])
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> Pipeline:
+        return _TimedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
 
 
-client = redis.from_url(settings.REDIS_URL, decode_responses=False)
+client = TimedRedis.from_url(settings.REDIS_URL, decode_responses=False)
 
 
 async def disconnect() -> None:
@@ -1,3 +1,7 @@
+from importlib.util import find_spec
+from typing import Literal
+
+from pydantic import Field, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -5,8 +9,66 @@ class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
 
     USE_REDIS_SESSIONS: bool = True
+    # signed token sessions take precedence over USE_REDIS_SESSIONS, and need a secret key
+    USE_SIGNED_SESSIONS: bool = False
+    SESSION_SECRET_KEY: str | None = None
     DATABASE_URL: str
     REDIS_URL: str
+    # argon2 runs in a thread pool of this size, and at most this many hashes may be queued
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_MAX_PENDING: int = 32
+    # rooms with local sockets are cached in-process for up to this many seconds; 0 disables
+    ROOM_SNAPSHOT_MAX_AGE: float = 30.0
+    # drawing updates are coalesced and published once per window of this length; 0 disables
+    DRAWING_FRAME_WINDOW_MS: int = 40
+    # the canvas snapshot sent to players joining mid-turn is saved at most this often, in seconds
+    CANVAS_SNAPSHOT_INTERVAL: float = 2.0
+    # the number of recent events kept per room, for reconnecting clients to catch up on
+    ROOM_EVENT_LOG_LENGTH: int = 200
+    # frames queued for a socket before its client counts as behind, and how long it may stay
+    # behind (in seconds) before it's disconnected
+    OUTBOUND_QUEUE_SIZE: int = 256
+    OUTBOUND_QUEUE_MAX_LAG: float = 5.0
+    # the encoding drawings are published in between workers; "msgpack" needs the msgpack
+    # extra installed
+    CHANNEL_ENCODING: Literal["json", "msgpack"] = "json"
+    # game loops are run by whichever worker holds the room's lease; a dead worker's rooms are
+    # taken over once their leases lapse, in seconds
+    GAME_LOOP_LEASE_TTL: float = 5.0
+    GAME_LOOP_MAX_PER_WORKER: int = 1000
+    # the word lists answers are drawn from, relative to the project root; see realtime/words.py
+    # for their format. they're checked for changes this often, in seconds; 0 disables reloading
+    WORD_LISTS: tuple[str, ...] = ("public/source.txt",)
+    WORD_LISTS_RELOAD_INTERVAL: float = 30.0
+    # token buckets limiting the frames each socket, and each room across all workers, may send:
+    # event type ("*" for the rest) -> (tokens per second, burst size). drawings over the limit
+    # are held back and coalesced; other frames are dropped
+    USER_RATE_LIMITS: dict[str, tuple[float, int]] = Field(
+        default_factory=lambda: {
+            "message": (2, 5),
+            "drawing": (30, 60),
+            "start": (0.2, 1),
+            "*": (5, 10),
+        }
+    )
+    ROOM_RATE_LIMITS: dict[str, tuple[float, int]] = Field(
+        default_factory=lambda: {"message": (10, 30), "drawing": (60, 120), "*": (20, 40)}
+    )
+    # a room's keys expire this many seconds after it was last used, or after ROOM_EMPTY_TTL if
+    # nobody is in it. keys that missed their expiry are swept up this often; 0 disables
+    ROOM_IDLE_TTL: int = 3600
+    ROOM_EMPTY_TTL: int = 120
+    ROOM_SWEEP_INTERVAL: float = 300.0
+    # a seat reserved by quick-joining is held this many seconds for the player to connect
+    ROOM_SEAT_RESERVATION_TTL: float = 30.0
+
+    @field_validator("CHANNEL_ENCODING")
+    @classmethod
+    def _check_channel_encoding(cls: type["Settings"], value: str) -> str:
+        # otherwise every drawing published would fail, rather than the server not starting
+        if value == "msgpack" and find_spec("msgpack") is None:
+            raise ValueError('"msgpack" needs the msgpack extra: poetry install -E msgpack')
+        return value
 
 
 settings = Settings()  # type: ignore
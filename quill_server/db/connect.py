@@ -1,6 +1,9 @@
 import os
+import time
 from collections.abc import AsyncGenerator
 
+from sqlalchemy import event
+from sqlalchemy.engine import ExecutionContext
 from sqlalchemy.ext.asyncio import (
     AsyncEngine,
     AsyncSession,
@@ -8,6 +11,8 @@ from sqlalchemy.ext.asyncio import (
     create_async_engine,
 )
 
+from quill_server.metrics import db_query_seconds
+
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
 if not DATABASE_URL:
@@ -17,6 +22,18 @@ engine: AsyncEngine = create_async_engine(DATABASE_URL)
 async_session = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
 
+# time every query (see metrics); these run on the event loop's thread
+@event.listens_for(engine.sync_engine, "before_cursor_execute", named=True)
+def _query_started(context: ExecutionContext, **_: object) -> None:
+    context._query_started = time.perf_counter()  # type: ignore[attr-defined]
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute", named=True)
+def _query_finished(context: ExecutionContext, **_: object) -> None:
+    started: float = context._query_started  # type: ignore[attr-defined]
+    db_query_seconds.observe(time.perf_counter() - started)
+
+
 async def get_db() -> AsyncGenerator[AsyncSession, None]:
     """Dependency used to supply database session."""
     async with async_session() as session:
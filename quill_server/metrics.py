@@ -0,0 +1,180 @@
+"""Metrics, served in the Prometheus text format at /metrics."""
+from bisect import bisect_left
+from collections.abc import Callable, Iterable
+
+
+# in seconds; from a fast Redis command to a slow database query
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# the response adds the charset
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _labels(name: str | None, value: str, *extra: str) -> str:
+    pairs = [*extra]
+    if name is not None:
+        escaped = value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+        pairs.insert(0, f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A count that only goes up, optionally split by one label.
+
+    Args:
+        name: The metric's name; counters' names end in `_total`.
+        doc: What it counts.
+        label: The name of the label values are split by, if any.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, label: str | None = None) -> None:
+        self.name = name
+        self.doc = doc
+        self.label = label
+        # label value -> count
+        self.values = dict[str, int]()
+
+    def inc(self, label: str = "") -> None:
+        self.values[label] = self.values.get(label, 0) + 1
+
+    def samples(self) -> Iterable[str]:
+        for label, value in self.values.items():
+            yield f"{self.name}{_labels(self.label, label)} {value}"
+
+
+class _Series:
+    __slots__ = ("counts", "total")
+
+    def __init__(self, n_buckets: int) -> None:
+        # observations per bucket, the last one being +Inf; not cumulative
+        self.counts = [0] * (n_buckets + 1)
+        self.total = 0.0
+
+
+class Histogram:
+    """The distribution of some value, optionally split by one label.
+
+    Args:
+        name: The metric's name.
+        doc: What it measures.
+        buckets: The buckets' upper bounds, in increasing order.
+        label: The name of the label values are split by, if any.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        label: str | None = None,
+    ) -> None:
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        self.label = label
+        # label value -> observations
+        self.series = dict[str, _Series]()
+
+    def observe(self, value: float, label: str = "") -> None:
+        series = self.series.get(label)
+        if series is None:
+            series = self.series[label] = _Series(len(self.buckets))
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.total += value
+
+    def samples(self) -> Iterable[str]:
+        for label, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series.counts, strict=True):
+                cumulative += count
+                le = _labels(self.label, label, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label, label)} {series.total}"
+            yield f"{self.name}_count{_labels(self.label, label)} {cumulative}"
+
+
+class Gauge:
+    """A value read from elsewhere whenever the metrics are scraped.
+
+    Args:
+        name: The metric's name.
+        doc: What it measures.
+        read: Returns the current value.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, read: Callable[[], float]) -> None:
+        self.name = name
+        self.doc = doc
+        self.read = read
+
+    def samples(self) -> Iterable[str]:
+        yield f"{self.name} {self.read()}"
+
+
+class Registry:
+    """The metrics a process serves.
+
+    Metrics are only ever updated from the event loop's thread, so they take no locks. Every
+    worker process has its own, so Prometheus should scrape each of them.
+    """
+
+    def __init__(self) -> None:
+        self.metrics = list[Counter | Histogram | Gauge]()
+
+    def counter(self, name: str, doc: str, label: str | None = None) -> Counter:
+        counter = Counter(name, doc, label)
+        self.metrics.append(counter)
+        return counter
+
+    def histogram(
+        self,
+        name: str,
+        doc: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        label: str | None = None,
+    ) -> Histogram:
+        histogram = Histogram(name, doc, buckets, label)
+        self.metrics.append(histogram)
+        return histogram
+
+    def gauge(self, name: str, doc: str, read: Callable[[], float]) -> Gauge:
+        gauge = Gauge(name, doc, read)
+        self.metrics.append(gauge)
+        return gauge
+
+    def render(self) -> str:
+        """All the metrics, in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.doc}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+events_processed = registry.counter(
+    "quill_events_processed_total", "Frames from clients processed, by event type", "event_type"
+)
+event_delivery_seconds = registry.histogram(
+    "quill_event_delivery_seconds",
+    "Time from an event being published to it being sent to a socket on this worker",
+)
+redis_command_seconds = registry.histogram(
+    "quill_redis_command_seconds",
+    "Redis round trips, by command; pipelines are PIPELINE or MULTI",
+    label="command",
+)
+db_query_seconds = registry.histogram("quill_db_query_seconds", "Database queries")
+password_hash_seconds = registry.histogram(
+    "quill_password_hash_seconds",
+    "argon2 hashes and verifications, not counting time queued for a thread",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+    label="operation",
+)
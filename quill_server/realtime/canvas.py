@@ -0,0 +1,54 @@
+"""The canvas of a room's current turn."""
+import zlib
+
+from redis.asyncio import Redis
+
+from quill_server.realtime.events import Drawing, DrawingEvent, ExcalidrawElement
+
+
+class Canvas:
+    """The elements drawn so far in a turn, at their latest version."""
+
+    def __init__(self) -> None:
+        # element ID -> element
+        self.elements = dict[str, ExcalidrawElement]()
+
+    def apply(self, elements: list[ExcalidrawElement]) -> list[ExcalidrawElement]:
+        """Merge elements into the canvas.
+
+        Args:
+            elements: Elements sent by the client, validated by `Drawing`; either the whole
+                canvas or just changes.
+
+        Returns:
+            The elements that are newer than the canvas' versions of them.
+        """
+        changed = []
+        for element in elements:
+            element_id = element.get("id")
+            if element_id is None:
+                continue
+            current = self.elements.get(element_id)
+            if current is not None and element.get("version", 0) <= current.get("version", 0):
+                continue
+            self.elements[element_id] = element
+            changed.append(element)
+        return changed
+
+
+def snapshot_key(room_id: str) -> str:
+    return f"room:{room_id}:canvas"
+
+
+async def save_snapshot(conn: Redis, room_id: str, drawing: Drawing) -> None:
+    """Save a room's canvas, as the DRAWING event that redraws it, compressed.
+
+    Players who connect mid-turn are sent the snapshot, instead of a blank board.
+    """
+    data = DrawingEvent(data=drawing).model_dump_json()
+    await conn.set(snapshot_key(room_id), zlib.compress(data.encode()))
+
+
+def decode_snapshot(data: bytes) -> str:
+    """Get the DRAWING event that redraws a canvas from its saved snapshot."""
+    return zlib.decompress(data).decode()
@@ -0,0 +1,142 @@
+"""Delta-encoded, coalesced DRAWING events."""
+import asyncio
+import time
+
+from loguru import logger
+from redis.asyncio import Redis
+
+from quill_server.config import settings
+from quill_server.realtime.canvas import Canvas, save_snapshot
+from quill_server.realtime.events import Drawing, DrawingEvent, EventType, ExcalidrawElement
+from quill_server.realtime.pubsub import Message, hub, publish
+from quill_server.realtime.room import GameMember, GameStatus
+
+
+class _PendingDrawing:
+    """The changes a drawer has made during the current frame window."""
+
+    def __init__(self, user: GameMember) -> None:
+        self.user = user
+        # element ID -> latest version of the element
+        self.elements = dict[str, ExcalidrawElement]()
+        self.updates = 0
+
+    def merge(self, elements: list[ExcalidrawElement]) -> None:
+        self.updates += 1
+        for element in elements:
+            self.elements[element["id"]] = element
+
+    def to_drawing(self) -> Drawing:
+        return Drawing(user=self.user, elements=list(self.elements.values()), updates=self.updates)
+
+
+class DrawingAggregator:
+    """Holds a room's canvas, and publishes its changes at most once per frame window.
+
+    Excalidraw reports every element on the canvas on nearly every pointer move, so only the
+    elements whose version increased are passed on. The aggregator lives on the worker serving
+    the drawer's socket, and is dropped once the worker has no sockets left in the room.
+
+    Args:
+        conn: The Redis client to publish with.
+        room_id: The room whose drawings are handled.
+        window: The frame window, in seconds. If 0, changes are published immediately.
+        snapshot_interval: The minimum time between saving snapshots of the canvas, in seconds.
+    """
+
+    def __init__(self, conn: Redis, room_id: str, window: float, snapshot_interval: float) -> None:
+        self.conn = conn
+        self.room_id = room_id
+        self.window = window
+        self.snapshot_interval = snapshot_interval
+        self.canvas = Canvas()
+        # the last user to draw on the canvas
+        self.drawer: GameMember | None = None
+        # user ID -> changes
+        self._pending = dict[str, _PendingDrawing]()
+        self._flush_task: asyncio.Task | None = None
+        self._snapshot_task: asyncio.Task | None = None
+        self._snapshot_at = 0.0
+
+    async def add(self, drawing: Drawing) -> None:
+        """Apply a drawing update to the canvas, and queue any changes to be published."""
+        changed = self.canvas.apply(drawing.elements)
+        if not changed:
+            return
+        self.drawer = drawing.user
+        if self._snapshot_task is None:
+            delay = max(0.0, self._snapshot_at + self.snapshot_interval - time.monotonic())
+            self._snapshot_task = asyncio.create_task(self._snapshot_after(delay))
+        if self.window <= 0:
+            data = Drawing(user=drawing.user, elements=changed, updates=drawing.updates)
+            await publish(self.conn, self.room_id, DrawingEvent(data=data))
+            return
+        pending = self._pending.get(drawing.user.user_id)
+        if pending is None:
+            pending = self._pending[drawing.user.user_id] = _PendingDrawing(drawing.user)
+        pending.merge(changed)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after_window())
+
+    async def _flush_after_window(self) -> None:
+        await asyncio.sleep(self.window)
+        pending, self._pending = self._pending, {}
+        self._flush_task = None
+        for drawing in pending.values():
+            if drawing.updates > 1:
+                logger.debug(
+                    f"room:{self.room_id}: merged {drawing.updates} drawing updates "
+                    f"from {drawing.user.username}"
+                )
+            await publish(self.conn, self.room_id, DrawingEvent(data=drawing.to_drawing()))
+
+    async def _snapshot_after(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._snapshot_task = None
+        self._snapshot_at = time.monotonic()
+        elements = list(self.canvas.elements.values())
+        await save_snapshot(self.conn, self.room_id, Drawing(user=self.drawer, elements=elements))
+
+    def close(self) -> None:
+        """Stop publishing and saving snapshots of the canvas; its turn is over."""
+        for task in (self._flush_task, self._snapshot_task):
+            if task is not None:
+                task.cancel()
+        self._flush_task = self._snapshot_task = None
+        self._pending.clear()
+
+
+# room ID -> aggregator, for rooms with a turn being drawn on this worker
+_aggregators = dict[str, DrawingAggregator]()
+
+
+def _clear_canvas(room_id: str, message: Message) -> None:
+    event_type = message.header["event_type"]
+    if event_type in (EventType.TURN_START, EventType.TURN_END) or (
+        event_type == EventType.GAME_STATE_CHANGE and message.header["status"] == GameStatus.ENDED
+    ):
+        if aggregator := _aggregators.pop(room_id, None):
+            aggregator.close()
+
+
+def _drop_canvas(room_id: str) -> None:
+    # nobody here is drawing in the room any more
+    if aggregator := _aggregators.pop(room_id, None):
+        aggregator.close()
+
+
+hub.observe_rooms(_clear_canvas)
+hub.observe_room_releases(_drop_canvas)
+
+
+async def emit_drawing(conn: Redis, room_id: str, drawing: Drawing) -> None:
+    """Publish the changes in a drawing update to its room."""
+    aggregator = _aggregators.get(room_id)
+    if aggregator is None:
+        aggregator = _aggregators[room_id] = DrawingAggregator(
+            conn,
+            room_id,
+            window=settings.DRAWING_FRAME_WINDOW_MS / 1000,
+            snapshot_interval=settings.CANVAS_SNAPSHOT_INTERVAL,
+        )
+    await aggregator.add(drawing)
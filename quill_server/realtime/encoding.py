@@ -0,0 +1,84 @@
+"""Wire encodings for room sockets."""
+import json
+import typing
+from enum import StrEnum
+from uuid import UUID
+
+from fastapi import WebSocket
+from pydantic import BaseModel
+
+
+# MessagePack makes drawing frames (long lists of numbers) smaller and faster to encode and
+# decode. it needs the `msgpack` extra; without it, only JSON is offered
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Encoding(StrEnum):
+    JSON = "json"
+    MSGPACK = "msgpack"
+
+
+# websocket subprotocol -> encoding. a client can also ask for one with `"encoding"` in its
+# authorization message, which is always JSON
+SUBPROTOCOLS = {f"quill.{encoding}": encoding for encoding in Encoding}
+
+
+def is_available(encoding: Encoding | None) -> bool:
+    """Whether an encoding can be used; False for None, e.g. for an unknown subprotocol."""
+    return encoding == Encoding.JSON or (encoding == Encoding.MSGPACK and msgpack is not None)
+
+
+def dumps(obj: dict[str, typing.Any], encoding: Encoding) -> str | bytes:
+    """Encode an object as a frame. JSON frames are text, MessagePack frames are bytes."""
+    if encoding == Encoding.MSGPACK:
+        return msgpack.packb(obj)
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def _fields(obj: object) -> dict[str, typing.Any] | str:
+    # packing nested models field by field skips model_dump, which walks every point of
+    # every drawing element and takes longer than the packing itself
+    if isinstance(obj, BaseModel):
+        return obj.__dict__
+    if isinstance(obj, UUID):
+        return str(obj)
+    raise TypeError(f"Cannot pack {type(obj).__name__}")
+
+
+def dump_model(model: BaseModel, encoding: Encoding) -> str | bytes:
+    """Encode a model as a frame, see `dumps`."""
+    if encoding == Encoding.MSGPACK:
+        return msgpack.packb(model, default=_fields)
+    return model.model_dump_json()
+
+
+def loads(frame: str | bytes, encoding: Encoding) -> dict[str, typing.Any]:
+    """Decode a frame."""
+    if encoding == Encoding.MSGPACK:
+        return msgpack.unpackb(frame)
+    return json.loads(frame)
+
+
+def transcode(frame: str | bytes, source: Encoding, target: Encoding) -> str | bytes:
+    """Convert a frame between encodings."""
+    if source == target:
+        return frame
+    return dumps(loads(frame, source), target)
+
+
+async def receive(ws: WebSocket, encoding: Encoding) -> dict[str, typing.Any]:
+    """Receive and decode a frame from a client."""
+    if encoding == Encoding.MSGPACK:
+        return msgpack.unpackb(await ws.receive_bytes())
+    return await ws.receive_json()
+
+
+async def send(ws: WebSocket, frame: str | bytes) -> None:
+    """Send a frame to a client, as a binary message if it's bytes."""
+    if isinstance(frame, bytes):
+        await ws.send_bytes(frame)
+    else:
+        await ws.send_text(frame)
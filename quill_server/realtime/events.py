@@ -1,29 +1,53 @@
 from enum import StrEnum, auto
 from functools import partial
-from typing import Any, Generic, TypeVar
-from collections.abc import Awaitable
-import typing
+from typing import Annotated, Any, Generic, TypeVar
 
 from loguru import logger
-from pydantic import BaseModel
+from pydantic import AfterValidator, BaseModel, TypeAdapter
 from redis.asyncio import Redis
 
-from quill_server.db.models import User
+from quill_server.metrics import events_processed
+from quill_server.schema import UserInfo
 from quill_server.realtime.room import GameMember, Room, ChatMessage, _db_user_to_game_member
+from quill_server.realtime.turn import Verdict, evaluate_guess
 from quill_server.schema import MessageResponse
 
 
 DataT = TypeVar("DataT", bound=BaseModel)
 
 
-# the excalidraw element event contains many fields
+def _check_element(element: dict[str, Any]) -> dict[str, Any]:
+    # canvases keep the latest copy of each element by ID, comparing versions (see canvas)
+    if not isinstance(element.get("id"), str):
+        raise ValueError("element id must be a string")
+    version = element.get("version", 0)
+    if not isinstance(version, int) or isinstance(version, bool):
+        raise ValueError("element version must be an integer")
+    return element
+
+
+# the excalidraw element event contains many fields, which are passed on as they are
 # https://github.com/excalidraw/excalidraw/blob/master/src/element/types.ts#L27-L141
-ExcalidrawElement = dict[str, Any]
+ExcalidrawElement = Annotated[dict[str, Any], AfterValidator(_check_element)]
 
 
 class Drawing(BaseModel):
     user: GameMember
     elements: list[ExcalidrawElement]
+    # the number of client updates coalesced into this one
+    updates: int = 1
+
+
+_elements = TypeAdapter(list[ExcalidrawElement])
+
+
+def validate_elements(elements: object) -> list[ExcalidrawElement]:
+    """Check the elements of a drawing sent by a client, as `Drawing` does.
+
+    Raises:
+        ValidationError: If they aren't a list of elements with IDs and integer versions.
+    """
+    return _elements.validate_python(elements)
 
 
 class EventType(StrEnum):
@@ -35,10 +59,12 @@ class EventType(StrEnum):
     GAME_STATE_CHANGE = auto()  # sent when the game starts or ends
     MESSAGE = auto()  # sent when any user sends a message in the chat
     CORRECT_GUESS = auto()  # sent when any user makes a correct guess
+    CLOSE_GUESS = auto()  # sent only to a user whose guess was close to the answer
     DRAWING = auto()  # sent when a user is drawing on the board
     TURN_START = auto()  # sent when a new turn starts
     TURN_END = auto()  # sent when a turn ends
     ERROR = auto()  # sent to a user if it tries some illegal action
+    REPLAY = auto()  # sent to a reconnecting user, with the events it missed
 
 
 class Event(BaseModel, Generic[DataT]):
@@ -57,7 +83,13 @@ GameStateChangeEvent = partial(Event[Room], event_type=EventType.GAME_STATE_CHAN
 DrawingEvent = partial(Event[Drawing], event_type=EventType.DRAWING)
 
 
-async def process_message(msg: dict[str, Any], room: Room, user: User, conn: Redis) -> Event:
+# events sent only to the user whose message caused them
+PERSONAL_EVENTS = {EventType.ERROR, EventType.CLOSE_GUESS}
+
+
+async def process_message(
+    msg: dict[str, Any], room: Room, user: UserInfo, conn: Redis
+) -> list[Event]:
     event_type = msg.get("event_type")
     event_data = msg.get("data")
     if not event_type:
@@ -65,53 +97,57 @@ async def process_message(msg: dict[str, Any], room: Room, user: User, conn: Red
     if not event_data:
         raise ValueError("Malformed message - no event data found")
 
-    match EventType(event_type):
+    kind = EventType(event_type)
+    events_processed.inc(kind)
+    match kind:
         case EventType.START:
             if str(user.id) == room.owner.user_id:
                 await room.start()
-                return GameStateChangeEvent(data=room)
+                return [GameStateChangeEvent(data=room)]
             else:
                 # user is not the room owner
                 data = MessageResponse(message="You do not own this room")
-                return Event[MessageResponse](event_type=EventType.ERROR, data=data)
+                return [Event[MessageResponse](event_type=EventType.ERROR, data=data)]
         case EventType.MESSAGE:
             # check if this user has already correctly guessed the answer
-            # or if this message is the correct guess
-            has_guessed = await typing.cast(
-                Awaitable[int], conn.sismember(f"room:{room.room_id}:guessed", str(user.id))
+            # or if this message is the correct guess; a correct guess also adds the user
+            # to the set of users who have guessed, and signals the game loop if everyone has
+            verdict, has_guessed = await evaluate_guess(
+                conn, room.room_id, str(user.id), event_data["message"]
             )
-            has_guessed = bool(has_guessed)
-            answer_res = await conn.get(f"room:{room.room_id}:answer")
-            if not answer_res:
-                logger.warning(f"Correct answer not found for room:{room.room_id}")
-                chat_message = ChatMessage(
-                    username=user.username, message=event_data["message"], has_guessed=has_guessed
-                )
-                return ChatMessageEvent(data=chat_message)
-            answer = answer_res.decode()
-            if event_data["message"].lower() == answer.lower() and not has_guessed:
-                # add this user to the set of users who have guessed correctly
-                await typing.cast(
-                    Awaitable[int], conn.sadd(f"room:{room.room_id}:guessed", str(user.id))
-                )
-                # replace the message content with a success message
-                chat_message = ChatMessage(
-                    username=user.username, message="Just guessed the answer!", has_guessed=True
-                )
-                return CorrectGuessEvent(data=chat_message)
-            elif event_data["message"].lower() == answer.lower():
-                # a user who has already guessed the answer is trying to leak the answer
-                chat_message = ChatMessage(username=user.username, message="****", has_guessed=True)
-                return ChatMessageEvent(data=chat_message)
-            else:
-                chat_message = ChatMessage(
-                    username=user.username, message=event_data["message"], has_guessed=has_guessed
-                )
-                return ChatMessageEvent(data=chat_message)
+            match verdict:
+                case Verdict.CORRECT:
+                    # replace the message content with a success message
+                    chat_message = ChatMessage(
+                        username=user.username, message="Just guessed the answer!", has_guessed=True
+                    )
+                    return [CorrectGuessEvent(data=chat_message)]
+                case Verdict.REPEATED:
+                    # a user who has already guessed the answer is trying to leak the answer
+                    chat_message = ChatMessage(
+                        username=user.username, message="****", has_guessed=True
+                    )
+                    return [ChatMessageEvent(data=chat_message)]
+                case _:
+                    if verdict == Verdict.NO_ANSWER:
+                        logger.warning(f"Correct answer not found for room:{room.room_id}")
+                    chat_message = ChatMessage(
+                        username=user.username,
+                        message=event_data["message"],
+                        has_guessed=has_guessed,
+                    )
+                    events: list[Event] = [ChatMessageEvent(data=chat_message)]
+                    if verdict == Verdict.CLOSE:
+                        # everyone sees the guess, but only the guesser hears it was close
+                        data = MessageResponse(message=f"{event_data['message']} is close!")
+                        events.append(
+                            Event[MessageResponse](event_type=EventType.CLOSE_GUESS, data=data)
+                        )
+                    return events
         case EventType.DRAWING:
             drawing = Drawing(
                 user=_db_user_to_game_member(user), elements=event_data.get("elements")
             )
-            return DrawingEvent(data=drawing)
+            return [DrawingEvent(data=drawing)]
         case _:
-            return Event(event_type=event_type, data=event_data)
+            return [Event(event_type=event_type, data=event_data)]
@@ -1,145 +1,412 @@
+"""The turn engine, which plays out the games of the rooms a worker runs."""
 import asyncio
 import contextlib
-import json
-import random
+import heapq
+import itertools
 import typing
-from functools import cache
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from enum import Enum, auto
 
 from loguru import logger
 from redis.asyncio import Redis
-from redis.exceptions import ConnectionError
+from redis.exceptions import RedisError
 
+from quill_server.realtime.canvas import snapshot_key
 from quill_server.realtime.events import Event, EventType, GameStateChangeEvent
-from quill_server.realtime.room import GameMember, GameStatus, Room, TurnEndData, TurnStartData
+from quill_server.realtime.lifecycle import close, touch
+from quill_server.realtime.pubsub import Message, Subscription, hub, publish
+from quill_server.realtime.room import (
+    GameMember,
+    GameStatus,
+    Room,
+    TurnEndData,
+    TurnStartData,
+    get_members,
+)
+from quill_server.realtime.turn import SIGNALS, answer_index, check_turn_complete
+from quill_server.realtime.words import key, word_bank
 
 
-@cache
-def words() -> list[str]:
-    with open("public/source.txt") as f:
-        return f.readlines()
+# how long to wait before subscribing to the turns channel again after failing to, in seconds
+_BACKOFF_INITIAL = 0.1
+_BACKOFF_MAX = 5.0
 
 
-# TODO: refactor? this code is so jank
-async def game_loop(cache: Redis, room_id: str) -> None:
-    logger.info(f"Game Loop[room={room_id}]: loop registered")
-    connect_tries = 0
-    async with cache.pubsub() as pubsub:
-        await pubsub.subscribe(f"room:{room_id}")
-        while True:
-            try:
-                message = await typing.cast(
-                    typing.Awaitable[dict[str, typing.Any] | None],
-                    pubsub.get_message(ignore_subscribe_messages=True),
-                )
-            except ConnectionError:
-                connect_tries += 1
-                if connect_tries == 50:
-                    logger.warning(
-                        "Pubsub could not connect to Redis after 50 retries. Is redis running?"
-                    )
-                    return
-                else:
-                    continue
-
-            if message is not None:
-                event = json.loads(message["data"])
-                event_type = EventType(event["event_type"])
-
-                if event_type == EventType.GAME_STATE_CHANGE:
-                    status = event["data"]["status"]
-                    if status == "ongoing":
-                        logger.info(
-                            f"Game Loop[room={room_id}]: Received GAME_STATE_CHANGE(start) event"
-                        )
-                        await rounds_loop(cache, room_id)
-                        # after the rounds loop has finished, send a GAME_STATE_CHANGE(ended) event
-                        # first, set the room's status as ended in redis
-                        await cache.set(f"room:{room_id}:status", str(GameStatus.ENDED))
-                        # next, fetch the entire room's data from redis
-                        room = await Room.from_redis(room_id)
-                        if not room:
-                            logger.error(
-                                f"Game Loop[room={room_id}]: room couldn't be retrieved from redis. "
-                                f"This should NEVER happen."
-                            )
-                            return
-                        event = GameStateChangeEvent(data=room)
-                        logger.info(f"Game Loop[room={room_id}]: Sent GAME_STATE_CHANGE(end) event")
-                        await cache.publish(f"room:{room_id}", event.model_dump_json())
-                        return
-
-
-async def _get_users(cache: Redis, room: str) -> list[GameMember]:
-    users_res = await typing.cast(
-        typing.Awaitable[list[bytes]], cache.lrange(f"room:{room}:users", 0, -1)
-    )
-    return [GameMember.model_validate_json(i) for i in users_res]
-
-
-async def poll_until_everyone_guesses(cache: Redis, room: str) -> None:
-    """
-    Keep polling redis until everyone in this room has guessed the answer.
-    This must be called with a timeout set.
+class Phase(Enum):
+    LOADING = auto()  # just handed to the engine; its status hasn't been read yet
+    LOBBY = auto()  # waiting for the game to start
+    TURN = auto()  # someone is drawing
+    COOLDOWN = auto()  # between turns
+
+
+@dataclass(slots=True)
+class RoomLoop:
+    """The state of a room's game, as far as the engine is concerned."""
+
+    room_id: str
+    phase: Phase = Phase.LOADING
+    # the current (or last) turn: the round, and the index of the drawer among its members
+    round_idx: int = 0
+    turn: int = 0
+    # the members drawing this round, in order
+    members: list[GameMember] = field(default_factory=list)
+    # the answers left for this game
+    word_pool: list[str] = field(default_factory=list)
+    # tags the turn's completion notices, so that a late notice can't end a later turn
+    turn_id: str | None = None
+    # whether a start notice has arrived
+    started: bool = False
+    # the turn ID of the last completion notice
+    completed: str | None = None
+    # when the room is next due to be advanced, by the event loop's clock
+    deadline: float | None = None
+    # the step advancing the room, while one is running
+    step: asyncio.Task | None = None
+    # whether the room came due while its step was still finishing, and should be advanced
+    # once it has
+    overdue: bool = False
+
+
+class TurnEngine:
+    """Runs the games of many rooms from a single task.
+
+    Rather than a coroutine per room, the engine keeps a state machine for each room and a
+    heap of their deadlines, and sleeps until the earliest one or a notice on the turns
+    channel. Rooms are handed to it, and taken back, by the scheduler.
+
+    Args:
+        conn: The Redis client.
+        n_rounds: The number of rounds in a game; every member draws once per round.
+        turn_seconds: How long each turn lasts, at most.
+        cooldown_seconds: The pause between turns.
+        max_steps: The most rooms advanced at once.
+        lobby_check_seconds: How often a room in its lobby is checked for having expired.
     """
-    while True:
-        guesses = await typing.cast(typing.Awaitable[int], cache.scard(f"room:{room}:guessed"))
-        n_members = await typing.cast(typing.Awaitable[int], cache.llen(f"room:{room}:users"))
-        if guesses == n_members:
-            logger.info(f"Game Loop[room={room}]: everyone has guessed")
+
+    def __init__(
+        self,
+        conn: Redis,
+        n_rounds: int = 1,
+        turn_seconds: float = 60,
+        cooldown_seconds: float = 2,
+        max_steps: int = 64,
+        lobby_check_seconds: float = 60,
+    ) -> None:
+        self.conn = conn
+        self.n_rounds = n_rounds
+        self.turn_seconds = turn_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.max_steps = max_steps
+        self.lobby_check_seconds = lobby_check_seconds
+        # room ID -> its state
+        self.rooms = dict[str, RoomLoop]()
+        # called with a room's ID, and whether its game is over, once the engine lets go of
+        # it: True if the game ended or the room is gone, False if its loop failed
+        self.on_finished: Callable[[str, bool], None] | None = None
+        # (deadline, tiebreaker, room ID); entries whose deadline no longer matches the
+        # room's are stale, and skipped
+        self._deadlines: list[tuple[float, int, str]] = []
+        self._counter = itertools.count()
+        self._steps = 0
+        self._signals: Subscription | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def steps(self) -> int:
+        """The number of rooms being advanced right now."""
+        return self._steps
+
+    @property
+    def running(self) -> bool:
+        """Whether the engine's task is running."""
+        return self._task is not None and not self._task.done()
+
+    def add(self, room_id: str) -> None:
+        """Start running a room's game, picking it up wherever it is."""
+        logger.info(f"Game Loop[room={room_id}]: loop registered")
+        room = RoomLoop(room_id)
+        self.rooms[room_id] = room
+        self._due(room, 0)
+
+    def remove(self, room_id: str) -> None:
+        """Stop running a room's game, e.g. when another worker has taken it over."""
+        room = self.rooms.pop(room_id, None)
+        if room is not None and room.step is not None:
+            room.step.cancel()
+
+    def _due(self, room: RoomLoop, delay: float) -> None:
+        """Advance a room after `delay` seconds."""
+        room.deadline = asyncio.get_running_loop().time() + delay
+        earliest = not self._deadlines or room.deadline < self._deadlines[0][0]
+        heapq.heappush(self._deadlines, (room.deadline, next(self._counter), room.room_id))
+        if earliest:
+            self._wake()
+
+    def _wake(self) -> None:
+        if self._signals is not None:
+            # an empty notice wakes the engine up to look at the heap again
+            self._signals.queue.put_nowait(Message(header={}, body=""))
+
+    def _on_signal(self, notice: dict[str, typing.Any]) -> None:
+        room = self.rooms.get(notice.get("room_id", ""))
+        if room is None:
             return
+        if notice.get("start"):
+            room.started = True
+            if room.phase == Phase.LOBBY and room.step is None:
+                logger.info(f"Game Loop[room={room.room_id}]: Received game start notice")
+                self._due(room, 0)
+        elif turn := notice.get("turn"):
+            room.completed = turn
+            if room.phase == Phase.TURN and room.step is None and turn == room.turn_id:
+                self._due(room, 0)
 
+    def _fire(self) -> None:
+        """Start a step for every room whose deadline has passed."""
+        # each step is a task of its own, so that a slow room doesn't hold up the others.
+        # only so many run at once, so that a burst of due rooms (say, a worker's worth taken
+        # over) doesn't open a Redis connection per room; the rest wait their turn in the heap
+        now = asyncio.get_running_loop().time()
+        while self._deadlines and self._deadlines[0][0] <= now and self._steps < self.max_steps:
+            deadline, _, room_id = heapq.heappop(self._deadlines)
+            room = self.rooms.get(room_id)
+            if room is None or room.deadline != deadline:
+                continue
+            if room.step is not None:
+                # the step scheduled the room just before ending, and its done callback
+                # hasn't run yet; it re-arms the room
+                room.overdue = True
+                continue
+            room.deadline = None
+            self._steps += 1
+            room.step = asyncio.create_task(self._advance(room), name=f"game-loop-{room_id}")
+            room.step.add_done_callback(lambda step, room=room: self._stepped(room, step))
 
-async def rounds_loop(
-    cache: Redis, room_id: str, n_rounds: int = 1, sec_per_round: int = 60
-) -> None:
-    # get the number of members initially
-    n_members = await typing.cast(typing.Awaitable[int], cache.llen(f"room:{room_id}:users"))
-    # get at least n_members * n_rounds random words
-    word_pool = [word.strip() for word in random.choices(words(), k=n_members * n_rounds)]
-    # room:id:current_draw_user stores the index of the user who has to draw next
-    for i in range(n_rounds):
-        logger.info(f"Game Loop[room={room_id}]: Round {i + 1} starting")
-        users = await _get_users(cache, room_id)
-        for idx, user in enumerate(users):
-            # step 0: ensure this user is still connected
-            is_still_connected = await typing.cast(
-                typing.Awaitable[int | str],
-                cache.lpos(f"room:{room_id}:users", user.model_dump_json()),
-            )
-            if not isinstance(is_still_connected, int):
-                # LPOS should return the index at which the element is found
-                # If the element wasn't found, LPOS returned nil, which is not an int
-                logger.info(
-                    f"Game Loop[room={room_id}]: User {user.username} is no longer connected; skipping"
-                )
+    def _stepped(self, room: RoomLoop, step: asyncio.Task) -> None:
+        room.step = None
+        self._steps -= 1
+        if self._steps == self.max_steps - 1:
+            # rooms may have been left waiting for a free slot
+            self._wake()
+        if step.cancelled() or self.rooms.get(room.room_id) is not room:
+            return
+        if exc := step.exception():
+            logger.opt(exception=exc).error(f"Game Loop[room={room.room_id}]: loop failed")
+            # the game isn't over; it's picked up again from its progress
+            self._finish(room, done=False)
+        elif room.overdue:
+            room.overdue = False
+            self._due(room, 0)
+
+    def _finish(self, room: RoomLoop, done: bool = True) -> None:
+        self.rooms.pop(room.room_id, None)
+        if self.on_finished is not None:
+            self.on_finished(room.room_id, done)
+
+    async def _advance(self, room: RoomLoop) -> None:
+        # only a game being played keeps the room alive; a room checked on in its lobby, or
+        # just handed to the engine, is left to expire if nobody is using it. before the step
+        # rather than after it, so that nothing awaits between the step scheduling the room
+        # and its end (see _on_signal). keys the step writes get their expiry on the next one
+        if room.started or room.phase in (Phase.TURN, Phase.COOLDOWN):
+            await touch(self.conn, room.room_id)
+        match room.phase:
+            case Phase.LOADING:
+                await self._load(room)
+            case Phase.LOBBY:
+                # due either because the game started, or to check the room is still there
+                await (self._play(room) if room.started else self._load(room))
+            case Phase.TURN:
+                await self._end_turn(room)
+            case Phase.COOLDOWN:
+                await self._next_turn(room, room.round_idx, room.turn + 1)
+
+    async def _load(self, room: RoomLoop) -> None:
+        # the room may be taken over from a worker that went away (see scheduler)
+        status = await self.conn.get(f"room:{room.room_id}:status")
+        if status is None or status == GameStatus.ENDED.encode():
+            # the room expired, or its game ended without its keys being deleted
+            await close(self.conn, room.room_id)
+            self._finish(room)
+            return
+        if status == GameStatus.ONGOING.encode():
+            progress = await self.conn.get(f"room:{room.room_id}:progress")
+            start = tuple(map(int, progress.split(b":"))) if progress else (0, 0)
+            logger.info(f"Game Loop[room={room.room_id}]: Resuming game from turn {start}")
+            await self._play(room, start)
+            return
+        room.phase = Phase.LOBBY
+        # the start notice may have arrived while the status was being read
+        if room.started:
+            await self._play(room)
+        else:
+            self._due(room, self.lobby_check_seconds)
+
+    async def _play(self, room: RoomLoop, start: tuple[int, int] = (0, 0)) -> None:
+        """Start a game's first turn, or the turn given when resuming it."""
+        room_id = room.room_id
+        async with self.conn.pipeline(transaction=True) as pipe:
+            # get the number of members initially, and the answers the room has had
+            pipe.hlen(f"room:{room_id}:members")
+            pipe.smembers(f"room:{room_id}:words")
+            n_members, used = await pipe.execute()
+        # draw n_members * n_rounds words the room hasn't had yet
+        room.word_pool = word_bank.sample(
+            n_members * self.n_rounds, exclude={word.decode() for word in used}
+        )
+        logger.info(f"Game Loop[room={room_id}]: Round {start[0] + 1} starting")
+        room.members = await get_members(self.conn, room_id)
+        await self._next_turn(room, *start)
+
+    async def _next_turn(self, room: RoomLoop, i: int, idx: int) -> None:
+        """Start turn `idx` of round `i`, or the first one after it with a drawer present."""
+        room_id = room.room_id
+        while True:
+            if idx >= len(room.members):
+                i, idx = i + 1, 0
+                if i >= self.n_rounds:
+                    await self._end_game(room)
+                    return
+                logger.info(f"Game Loop[room={room_id}]: Round {i + 1} starting")
+                room.members = await get_members(self.conn, room_id)
                 continue
-            # step 1: set the answer for this turn
-            answer = word_pool.pop()
-            logger.info(f"Game Loop[room={room_id}]: set room:{room_id}:answer={answer}")
-            await cache.set(f"room:{room_id}:answer", answer)
-            # step 2: initialize the set of users who have guessed the answer
-            # add the user who is drawing to the set, so that we won't be waiting
-            # for them to correctly guess their own drawing
-            await typing.cast(
-                typing.Awaitable[int], cache.sadd(f"room:{room_id}:guessed", user.user_id)
+            user = room.members[idx]
+            # ensure this user is still connected
+            is_still_connected = await typing.cast(
+                typing.Awaitable[bool],
+                self.conn.hexists(f"room:{room_id}:members", user.user_id),
             )
-            start_data = TurnStartData(user=GameMember.model_validate(user), answer=answer)
+            if is_still_connected:
+                break
             logger.info(
-                f"Game Loop[room={room_id}]: User {user.username}'s turn to draw; answer is {start_data.answer}"
+                f"Game Loop[room={room_id}]: User {user.username} is no longer connected; skipping"
+            )
+            idx += 1
+        room.round_idx, room.turn = i, idx
+        # members who left and came back may have made the pool too small
+        answer = room.word_pool.pop() if room.word_pool else word_bank.sample(1)[0]
+        logger.info(f"Game Loop[room={room_id}]: set room:{room_id}:answer={answer}")
+        # guesses are compared casefolded (see evaluate_guess); index the answer for close
+        # guess checks now, rather than on the first guess
+        stored = answer.casefold()
+        answer_index(stored)
+        # the turn id tags completion notices, so that a late notice from an earlier turn
+        # can't end this one
+        room.turn_id = f"{i}:{idx}"
+        async with self.conn.pipeline(transaction=True) as pipe:
+            pipe.set(f"room:{room_id}:answer", stored)
+            pipe.sadd(f"room:{room_id}:words", key(answer))
+            # a snapshot saved just as the last turn ended may have outlived its delete
+            pipe.delete(snapshot_key(room_id))
+            # add the user who is drawing to the set of users who have guessed the answer,
+            # so that we won't be waiting for them to correctly guess their own drawing
+            pipe.sadd(f"room:{room_id}:guessed", user.user_id)
+            # unlike the turn id, the progress outlives the turn; an engine taking over the
+            # room (see scheduler) restarts from there
+            pipe.mset(
+                {f"room:{room_id}:turn": room.turn_id, f"room:{room_id}:progress": room.turn_id}
             )
-            # step 3: send the TURN_START event
-            start_event = Event[TurnStartData](event_type=EventType.TURN_START, data=start_data)
-            await cache.publish(f"room:{room_id}", start_event.model_dump_json())
-            # step 4: wait for 60 seconds, or until every user has guessed the answer (whichever comes first)
+            await pipe.execute()
+        start_data = TurnStartData(user=GameMember.model_validate(user), answer=answer)
+        logger.info(
+            f"Game Loop[room={room_id}]: User {user.username}'s turn to draw; answer is {start_data.answer}"
+        )
+        start_event = Event[TurnStartData](event_type=EventType.TURN_START, data=start_data)
+        await publish(self.conn, room_id, start_event)
+        room.phase = Phase.TURN
+        # the turn ends after turn_seconds, or once every user has guessed the answer
+        # (whichever comes first). correct guesses publish a completion notice once
+        # everyone has guessed; check once up front in case the drawer is alone
+        await check_turn_complete(self.conn, room_id)
+        self._due(room, 0 if room.completed == room.turn_id else self.turn_seconds)
+
+    async def _end_turn(self, room: RoomLoop) -> None:
+        room_id = room.room_id
+        # clear the room:{id}:guessed set, the turn id and the canvas
+        await self.conn.delete(
+            f"room:{room_id}:guessed", f"room:{room_id}:turn", snapshot_key(room_id)
+        )
+        end_event = Event[TurnEndData](
+            event_type=EventType.TURN_END, data=TurnEndData(turn=room.turn)
+        )
+        await publish(self.conn, room_id, end_event)
+        # add some cooldown between turns
+        room.phase = Phase.COOLDOWN
+        self._due(room, self.cooldown_seconds)
+
+    async def _end_game(self, room: RoomLoop) -> None:
+        room_id = room.room_id
+        # set the room's status as ended in redis, then send a GAME_STATE_CHANGE(ended) event
+        # with the entire room's data
+        await self.conn.set(f"room:{room_id}:status", str(GameStatus.ENDED))
+        state = await Room.from_redis(room_id)
+        if not state:
+            logger.error(
+                f"Game Loop[room={room_id}]: room couldn't be retrieved from redis. "
+                f"This should NEVER happen."
+            )
+        else:
+            logger.info(f"Game Loop[room={room_id}]: Sent GAME_STATE_CHANGE(end) event")
+            await publish(self.conn, room_id, GameStateChangeEvent(data=state))
+        await close(self.conn, room_id)
+        self._finish(room)
+
+    async def _serve(self, signals: Subscription) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._fire()
+            # with every step slot taken, a finishing step wakes the engine up instead
+            if self._deadlines and self._steps < self.max_steps:
+                timeout = max(self._deadlines[0][0] - loop.time(), 0)
+            else:
+                timeout = None
             with contextlib.suppress(TimeoutError):
-                await asyncio.wait_for(
-                    poll_until_everyone_guesses(cache, room_id), timeout=sec_per_round
+                notice = await asyncio.wait_for(signals.queue.get(), timeout=timeout)
+                self._on_signal(notice.header)
+
+    async def _run(self) -> None:
+        delay = _BACKOFF_INITIAL
+        while True:
+            try:
+                async with hub.subscribe(SIGNALS) as signals:
+                    self._signals = signals
+                    delay = _BACKOFF_INITIAL
+                    await self._serve(signals)
+            except RedisError as e:
+                # rooms stay in the heap, and are advanced once the engine is back
+                logger.warning(
+                    f"Game Loop: couldn't subscribe to {SIGNALS}: {e}; retrying in {delay:.1f}s"
                 )
-            # step 5: clear the room:{id}:guessed set
-            await cache.delete(f"room:{room_id}:guessed")
-            # step 6: publish TURN_END event
-            end_data = TurnEndData(turn=idx)
-            end_event = Event[TurnEndData](event_type=EventType.TURN_END, data=end_data)
-            await cache.publish(f"room:{room_id}", end_event.model_dump_json())
-            # step 7: sleep for 2 seconds to add some cooldown between rounds
-            await asyncio.sleep(2)
+            finally:
+                self._signals = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, _BACKOFF_MAX)
+
+    def _stopped(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and (exc := task.exception()):
+            logger.opt(exception=exc).error("Game Loop: engine stopped")
+
+    async def start(self) -> None:
+        """Start advancing rooms."""
+        self._task = asyncio.create_task(self._run(), name="turn-engine")
+        self._task.add_done_callback(self._stopped)
+
+    async def stop(self) -> list[str]:
+        """Stop advancing rooms.
+
+        Returns:
+            The IDs of the rooms whose games were still running.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        self._signals = None
+        rooms, self.rooms = self.rooms, {}
+        for room in rooms.values():
+            if room.step is not None:
+                room.step.cancel()
+        self._deadlines.clear()
+        return list(rooms)
@@ -0,0 +1,230 @@
+"""The lifetime of a room's keys in Redis, which expire unless the room is in use."""
+import asyncio
+import contextlib
+import typing
+from dataclasses import dataclass
+from uuid import uuid4
+
+from loguru import logger
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from quill_server import cache
+from quill_server.config import settings
+from quill_server.realtime.lobby import OPEN_ROOMS, prune
+
+
+# the keys a room may have, other than its rate limit buckets, which expire seconds after
+# they're last used (see ratelimit). status comes first and members second, as the scripts
+# below expect
+_SUFFIXES = (
+    "status",
+    "members",
+    "owner",
+    "order",
+    "departed",
+    "seats",
+    "answer",
+    "guessed",
+    "turn",
+    "progress",
+    "words",
+    "canvas",
+    "seq",
+    "log",
+    # rooms from before members were stored in a hash, see room.migrate_members
+    "users",
+)
+
+# deletes the keys in KEYS, returning {the number deleted, roughly how many bytes they took}
+_RECLAIM = """
+local function reclaim(keys)
+    local bytes = 0
+    for _, key in ipairs(keys) do
+        bytes = bytes + (redis.call("MEMORY", "USAGE", key) or 0)
+    end
+    return {redis.call("DEL", unpack(keys)), bytes}
+end
+"""
+
+# slide the expiry of KEYS (see `_keys`) to ARGV[1] seconds from now, or ARGV[2] if the room
+# has no members. if the room has no status, it's gone, and KEYS are deleted instead
+_TOUCH = (
+    _RECLAIM
+    + """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return reclaim(KEYS)
+end
+local ttl = redis.call("HLEN", KEYS[2]) > 0 and ARGV[1] or ARGV[2]
+for _, key in ipairs(KEYS) do
+    redis.call("EXPIRE", key, ttl)
+end
+return {0, 0}
+"""
+)
+
+_CLOSE = _RECLAIM + "return reclaim(KEYS)"
+
+_touch = cache.client.register_script(_TOUCH)
+_close = cache.client.register_script(_CLOSE)
+
+# a socket touches its room at most this often, in seconds, while it's sending frames
+TOUCH_INTERVAL = settings.ROOM_IDLE_TTL / 10
+# a lock making sure only one worker sweeps per interval
+_SWEEP_LOCK = "rooms:sweep"
+
+
+def _keys(room_id: str) -> list[str]:
+    return [f"room:{room_id}:{suffix}" for suffix in _SUFFIXES]
+
+
+@dataclass(slots=True)
+class Reclaimed:
+    """What deleting rooms' keys freed up."""
+
+    rooms: int = 0
+    keys: int = 0
+    # as MEMORY USAGE estimates them
+    nbytes: int = 0
+
+    def add(self, keys: int, nbytes: int) -> None:
+        if keys:
+            self.rooms += 1
+            self.keys += keys
+            self.nbytes += nbytes
+
+
+async def touch(conn: Redis, room_id: str) -> Reclaimed:
+    """Push back the expiry of a room's keys, or delete them if the room is gone.
+
+    Follows every write that makes up a room, so that an abandoned room lingers only long
+    enough for its members to reconnect.
+
+    Returns:
+        What was deleted, if anything.
+    """
+    keys, nbytes = await typing.cast(
+        typing.Awaitable[list[int]],
+        _touch(
+            _keys(room_id),
+            [settings.ROOM_IDLE_TTL, settings.ROOM_EMPTY_TTL],
+            client=conn,
+        ),
+    )
+    reclaimed = Reclaimed()
+    reclaimed.add(keys, nbytes)
+    return reclaimed
+
+
+async def close(conn: Redis, room_id: str) -> Reclaimed:
+    """Delete all of a room's keys, and take it out of the quick-join index."""
+    async with conn.pipeline(transaction=True) as pipe:
+        await _close(_keys(room_id), client=pipe)
+        pipe.zrem(OPEN_ROOMS, room_id)
+        (keys, nbytes), _ = await pipe.execute()
+    logger.info(f"Deleted {keys} keys ({nbytes} bytes) of room:{room_id}")
+    reclaimed = Reclaimed()
+    reclaimed.add(keys, nbytes)
+    return reclaimed
+
+
+class RoomSweeper:
+    """Periodically finds room keys without an expiry, and touches their rooms.
+
+    Keys can be left without one by a worker dying between a write and its touch, or by
+    rooms created before keys expired. Rooms that are gone are also dropped from the
+    quick-join index.
+
+    Args:
+        conn: The Redis client.
+        interval: How often to sweep, in seconds; 0 never.
+        batch: How many keys to ask SCAN for at a time.
+    """
+
+    def __init__(self, conn: Redis, interval: float, batch: int = 1000) -> None:
+        self.conn = conn
+        self.interval = interval
+        self.batch = batch
+        self.worker_id = uuid4().hex
+        self._task: asyncio.Task | None = None
+
+    async def sweep(self) -> Reclaimed:
+        """Touch every room with a key that doesn't expire.
+
+        Returns:
+            What was deleted, of rooms that were gone.
+        """
+        reclaimed = Reclaimed()
+        seen = set[bytes]()
+        async for keys in self._scan():
+            async with self.conn.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.ttl(key)
+                ttls = await pipe.execute()
+            for key, ttl in zip(keys, ttls, strict=True):
+                # -1 is a key without an expiry; -2 one that has gone since the scan
+                room_id = key.split(b":")[1]
+                if ttl != -1 or room_id in seen:
+                    continue
+                seen.add(room_id)
+                gone = await touch(self.conn, room_id.decode())
+                reclaimed.add(gone.keys, gone.nbytes)
+        pruned = await prune(self.conn, self.batch)
+        logger.info(
+            f"RoomSweeper: touched {len(seen)} rooms; deleted {reclaimed.keys} keys "
+            f"({reclaimed.nbytes} bytes) of {reclaimed.rooms} that were gone, and dropped "
+            f"{pruned} from the quick-join index"
+        )
+        return reclaimed
+
+    async def _scan(self) -> typing.AsyncIterator[list[bytes]]:
+        cursor = 0
+        while True:
+            cursor, keys = await self.conn.scan(cursor, match="room:*", count=self.batch)
+            # room:{id}:{key}; rate limit buckets always expire, so don't matter here
+            keys = [key for key in keys if key.count(b":") >= 2]
+            if keys:
+                yield keys
+            if cursor == 0:
+                return
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # whichever worker gets here first sweeps; the lock lapses just before the
+                # next sweep is due
+                locked = await self.conn.set(
+                    _SWEEP_LOCK, self.worker_id, nx=True, px=int(self.interval * 900)
+                )
+                if locked:
+                    await self.sweep()
+            except RedisError as e:
+                logger.warning(f"RoomSweeper: couldn't sweep room keys: {e}")
+            except Exception:
+                # a bad key mustn't stop every later sweep
+                logger.opt(exception=True).error("RoomSweeper: sweep failed")
+
+    @property
+    def running(self) -> bool:
+        """Whether the sweeper's task is running."""
+        return self._task is not None and not self._task.done()
+
+    def _stopped(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and (exc := task.exception()):
+            logger.opt(exception=exc).error("RoomSweeper: stopped")
+
+    async def start(self) -> None:
+        """Start sweeping periodically."""
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run(), name="room-sweeper")
+            self._task.add_done_callback(self._stopped)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+
+sweeper = RoomSweeper(cache.client, settings.ROOM_SWEEP_INTERVAL)
@@ -0,0 +1,136 @@
+"""The index of rooms players can quick-join."""
+import typing
+
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+
+from quill_server import cache
+from quill_server.config import settings
+
+
+# room ID -> members and reserved seats, of rooms in their lobby with space. every change to
+# a room's status or members re-scores it in the same transaction; rooms that are gone are
+# dropped when quick-joining comes across them, and by the sweeper (see lifecycle)
+OPEN_ROOMS = "rooms:open"
+# the most members a room may have
+CAPACITY = 8
+
+# for scripts that change rooms: drops a room's lapsed reservations, and re-scores it in the
+# index, given the index's key, the room's key prefix and its ID. returns the room's members
+# and reserved seats. the rooms' keys aren't all declared in KEYS, so this needs a single
+# Redis rather than a cluster
+REINDEX = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local function reindex(index, key, room_id, capacity)
+    redis.call("ZREMRANGEBYSCORE", key .. ":seats", "-inf", now)
+    local members = redis.call("HLEN", key .. ":members")
+    local fill = members + redis.call("ZCARD", key .. ":seats")
+    -- an empty room has nobody to play with, and is about to expire
+    if redis.call("GET", key .. ":status") == "lobby" and members < capacity and fill > 0 then
+        redis.call("ZADD", index, fill, room_id)
+    else
+        redis.call("ZREM", index, room_id)
+    end
+    return fill
+end
+"""
+
+# re-score room ARGV[1] in the index KEYS[1], with capacity ARGV[2]
+_REINDEX_ROOM = REINDEX + 'return reindex(KEYS[1], "room:" .. ARGV[1], ARGV[1], tonumber(ARGV[2]))'
+
+# reserve a seat for user ARGV[1] for ARGV[3] ms in the fullest room in the index KEYS[1]
+# with space, out of capacity ARGV[2]; the fullest, so that games fill up and start rather
+# than players spreading thin. reservations are kept in room:{id}:seats, user ID -> when the
+# reservation lapses, in ms of Redis server time. looks at up to ARGV[4] rooms, and returns
+# the ID of the room, or nil if none had space
+_RESERVE = (
+    REINDEX
+    + """
+local user, capacity = ARGV[1], tonumber(ARGV[2])
+local ttl, candidates = tonumber(ARGV[3]), tonumber(ARGV[4])
+
+local function reserve(room_id)
+    local key = "room:" .. room_id
+    if redis.call("HEXISTS", key .. ":members", user) == 1 then
+        return false
+    end
+    local fill = reindex(KEYS[1], key, room_id, capacity)
+    local held = redis.call("ZSCORE", key .. ":seats", user)
+    if redis.call("ZSCORE", KEYS[1], room_id) == false or (fill >= capacity and not held) then
+        return false
+    end
+    redis.call("ZADD", key .. ":seats", now + ttl, user)
+    redis.call("PEXPIRE", key .. ":seats", ttl)
+    reindex(KEYS[1], key, room_id, capacity)
+    return true
+end
+
+-- rooms with space, fullest first
+local open = redis.call(
+    "ZREVRANGEBYSCORE", KEYS[1], "(" .. capacity, "-inf", "LIMIT", 0, candidates
+)
+for _, room_id in ipairs(open) do
+    if reserve(room_id) then
+        return room_id
+    end
+end
+-- rooms filled up by reservations, some of which may have lapsed
+local reserved = redis.call("ZRANGEBYSCORE", KEYS[1], capacity, capacity, "LIMIT", 0, candidates)
+for _, room_id in ipairs(reserved) do
+    if reserve(room_id) then
+        return room_id
+    end
+end
+return nil
+"""
+)
+
+_reindex = cache.client.register_script(_REINDEX_ROOM)
+_reserve = cache.client.register_script(_RESERVE)
+
+# the most rooms looked at per quick-join
+_CANDIDATES = 16
+
+
+async def reindex(client: Redis | Pipeline, room_id: str) -> None:
+    """Re-score a room in the index; with a pipeline, this is queued in it."""
+    await _reindex([OPEN_ROOMS], [room_id, CAPACITY], client=client)
+
+
+async def reserve_seat(conn: Redis, user_id: str) -> str | None:
+    """Reserve a seat for a user in the fullest room with space.
+
+    Returns:
+        The ID of the room, or None if no room has space.
+    """
+    ttl = int(settings.ROOM_SEAT_RESERVATION_TTL * 1000)
+    room_id = await typing.cast(
+        typing.Awaitable[bytes | None],
+        _reserve([OPEN_ROOMS], [user_id, CAPACITY, ttl, _CANDIDATES], client=conn),
+    )
+    return room_id.decode() if room_id is not None else None
+
+
+async def prune(conn: Redis, batch: int = 1000) -> int:
+    """Drop rooms that no longer exist from the index.
+
+    Returns:
+        The number of rooms dropped.
+    """
+    pruned = 0
+    cursor = 0
+    while True:
+        cursor, entries = await conn.zscan(OPEN_ROOMS, cursor, count=batch)
+        rooms = [room_id for room_id, _ in entries]
+        if rooms:
+            async with conn.pipeline(transaction=False) as pipe:
+                for room_id in rooms:
+                    pipe.exists(f"room:{room_id.decode()}:status")
+                exists = await pipe.execute()
+            gone = [room_id for room_id, e in zip(rooms, exists, strict=True) if not e]
+            if gone:
+                pruned += await conn.zrem(OPEN_ROOMS, *gone)
+        if cursor == 0:
+            return pruned
@@ -0,0 +1,180 @@
+"""Bounded outgoing queues for websockets."""
+import asyncio
+import time
+from collections import deque
+
+from fastapi import WebSocket, status
+from loguru import logger
+from starlette.websockets import WebSocketState
+
+from quill_server.metrics import event_delivery_seconds
+from quill_server.realtime.encoding import Encoding, dumps, loads, send
+from quill_server.realtime.events import EventType
+
+
+# events after which the canvas starts over, so drawing frames can't be merged across them
+_CANVAS_BOUNDARIES = {EventType.TURN_START, EventType.TURN_END, EventType.GAME_STATE_CHANGE}
+
+
+def _merge_drawing(merged: dict, drawing: dict) -> None:
+    for element in drawing["elements"]:
+        current = merged["elements"].get(element["id"])
+        if current is None or element.get("version", 0) > current.get("version", 0):
+            merged["elements"][element["id"]] = element
+    merged["user"] = drawing["user"]
+    merged["updates"] += drawing["updates"]
+
+
+def _dump_drawing(merged: dict, encoding: Encoding) -> str | bytes:
+    data = merged | {"elements": list(merged["elements"].values())}
+    return dumps({"event_type": EventType.DRAWING, "data": data}, encoding)
+
+
+class Outbox:
+    """A websocket's bounded queue of outgoing frames, and the task sending them.
+
+    A slow client only holds up itself, rather than the room subscription feeding it. When the
+    queue fills up, its drawing frames are merged; a client that stays behind for too long is
+    disconnected, and can reconnect to catch up from the room's event log.
+
+    Args:
+        ws: The websocket frames are sent over.
+        maxsize: The number of frames that may be queued before the client is behind.
+        max_lag: How long the client may stay behind before it is disconnected, in seconds.
+        encoding: The encoding of the frames.
+    """
+
+    def __init__(
+        self, ws: WebSocket, maxsize: int, max_lag: float, encoding: Encoding = Encoding.JSON
+    ) -> None:
+        self.ws = ws
+        self.maxsize = maxsize
+        self.max_lag = max_lag
+        self.encoding = encoding
+        # (event type, frame, when it was published)
+        self._frames = deque[tuple[str, str | bytes, float | None]]()
+        self._ready = asyncio.Event()
+        self._closed = False
+        self._writer: asyncio.Task | None = None
+        # when the queue last became full, while it stays full
+        self.behind_since: float | None = None
+        # the number of drawing frames merged away
+        self.dropped = 0
+        # whether the client was disconnected for being too far behind
+        self.evicted = False
+
+    @property
+    def depth(self) -> int:
+        """The number of frames waiting to be sent."""
+        return len(self._frames)
+
+    def put(self, event_type: str, frame: str | bytes, published: float | None = None) -> bool:
+        """Queue a frame to be sent.
+
+        Args:
+            event_type: The type of the event in the frame.
+            frame: The encoded event.
+            published: When the event was published, as a UNIX timestamp, to time its delivery.
+
+        Returns:
+            False if the client is too far behind, and should be disconnected.
+        """
+        self._frames.append((event_type, frame, published))
+        self._ready.set()
+        if len(self._frames) <= self.maxsize:
+            return True
+        self._merge_drawings()
+        if len(self._frames) <= self.maxsize:
+            return True
+        now = time.monotonic()
+        if self.behind_since is None:
+            self.behind_since = now
+        return now - self.behind_since < self.max_lag and len(self._frames) < self.maxsize * 2
+
+    def _merge_drawings(self) -> None:
+        """Merge the queued drawing frames of each turn into one, at the latest one's place."""
+        frames: list[tuple[str, str | bytes | dict, float | None] | None] = []
+        # the current turn's merged drawing, with its elements by ID, and its index in frames
+        merged: dict | None = None
+        merged_at = 0
+        # when the earliest frame merged into it was published, so the wait isn't hidden
+        merged_since: float | None = None
+        for event_type, frame, published in self._frames:
+            if event_type != EventType.DRAWING:
+                if event_type in _CANVAS_BOUNDARIES:
+                    merged = None
+                frames.append((event_type, frame, published))
+                continue
+            drawing = loads(frame, self.encoding)["data"]
+            if merged is None:
+                merged = drawing | {"elements": {e["id"]: e for e in drawing["elements"]}}
+                merged_since = published
+            else:
+                _merge_drawing(merged, drawing)
+                frames[merged_at] = None
+                self.dropped += 1
+                merged_since = merged_since if merged_since is not None else published
+            frames.append((event_type, merged, merged_since))
+            merged_at = len(frames) - 1
+        self._frames.clear()
+        for entry in frames:
+            if entry is not None:
+                event_type, frame, published = entry
+                self._frames.append(
+                    (
+                        event_type,
+                        _dump_drawing(frame, self.encoding) if isinstance(frame, dict) else frame,
+                        published,
+                    )
+                )
+
+    async def _write(self) -> None:
+        while True:
+            while self._frames:
+                if self.ws.client_state != WebSocketState.CONNECTED:
+                    # the client is gone; nothing left to send to
+                    return
+                _, frame, published = self._frames.popleft()
+                await send(self.ws, frame)
+                if published is not None:
+                    event_delivery_seconds.observe(time.time() - published)
+                if len(self._frames) <= self.maxsize:
+                    self.behind_since = None
+            if self._closed:
+                return
+            self._ready.clear()
+            await self._ready.wait()
+
+    def start(self) -> None:
+        """Start sending queued frames."""
+        self._writer = asyncio.create_task(self._write())
+        outboxes.add(self)
+
+    def clear(self) -> None:
+        """Drop every queued frame."""
+        self._frames.clear()
+
+    async def close(self) -> None:
+        """Send the frames still queued, then stop."""
+        self._closed = True
+        self._ready.set()
+        if self._writer is not None:
+            await self._writer
+        outboxes.discard(self)
+
+    async def evict(self) -> None:
+        """Stop sending, and disconnect the client."""
+        logger.warning(
+            f"Disconnecting a slow client; {self.depth} frames behind, {self.dropped} dropped"
+        )
+        self.evicted = True
+        self.clear()
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        outboxes.discard(self)
+        await self.ws.close(status.WS_1013_TRY_AGAIN_LATER, "Too far behind")
+
+
+# every running outbox in this process, for inspecting queue depths and drops
+outboxes = set[Outbox]()
@@ -1,7 +1,10 @@
 import asyncio
 import json
+import random
+import time
 import typing
-from dataclasses import dataclass
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
 
 from fastapi import WebSocket
 from loguru import logger
@@ -9,7 +12,11 @@ from redis.exceptions import ConnectionError
 from redis.asyncio import Redis
 from redis.asyncio.client import PubSub
 
-from quill_server.db.models import User
+from quill_server import cache
+from quill_server.config import settings
+from quill_server.schema import UserInfo
+from quill_server.realtime.canvas import decode_snapshot, snapshot_key
+from quill_server.realtime.encoding import Encoding, dump_model, dumps, transcode
 from quill_server.realtime.events import (
     ConnectEvent,
     Event,
@@ -17,81 +24,468 @@ from quill_server.realtime.events import (
     MemberJoinEvent,
     MemberLeaveEvent,
 )
-from quill_server.realtime.room import Room, _db_user_to_game_member
+from quill_server.realtime.outbox import Outbox
+from quill_server.realtime.room import GameStatus, Room, _db_user_to_game_member, room_snapshots
 
 
-# set of scheduled Tasks
-# this is done as the event loop does not keep any strong refs
-# to scheduled tasks, and they may get garbage collected before
-# completion. so we add them to this set (thereby creating strong refs)
-# and not allowing them to be garbage collected.
-# read: https://docs.python.org/3/library/asyncio-task.html#asyncio.create_task
-_bg_tasks = set()
+# reconnect backoff for pub/sub readers, in seconds
+_BACKOFF_INITIAL = 0.1
+_BACKOFF_MAX = 5.0
+
+# numbers an event, appends it to the room's capped event log and publishes it, atomically.
+# the sequence number is spliced into the front of both the header and the body.
+# KEYS: sequence, log; ARGV: channel, header, body, log length, event type
+_LOG_AND_PUBLISH = """
+local seq = redis.call("INCR", KEYS[1])
+local prefix = '{"seq":' .. seq .. ','
+local body = prefix .. string.sub(ARGV[3], 2)
+redis.call("XADD", KEYS[2], "MAXLEN", "~", ARGV[4], "0-" .. seq, "type", ARGV[5], "body", body)
+redis.call("PUBLISH", ARGV[1], prefix .. string.sub(ARGV[2], 2) .. "\\n" .. body)
+return seq
+"""
+
+_log_and_publish = cache.client.register_script(_LOG_AND_PUBLISH)
+
+
+@dataclass(slots=True)
+class Message:
+    """A message received on a channel.
+
+    Events are published as a small JSON routing header line followed by the event's JSON,
+    so that subscribers can decide what to do with a message by reading only the header,
+    and forward the body to clients as-is. Messages published without a body (such as
+    turn completion notices) are entirely header.
+
+    Drawings may be published with a MessagePack body instead (see CHANNEL_ENCODING),
+    marked by `"enc": "msgpack"` in the header.
+    """
+
+    header: dict[str, typing.Any]
+    body: str | bytes
+    encoding: Encoding = Encoding.JSON
+    # encoding -> body in that encoding, converted once for every socket that needs it
+    _frames: dict[Encoding, str | bytes] = field(default_factory=dict)
+
+    @classmethod
+    def parse(cls: type["Message"], data: bytes) -> "Message":
+        header, _, body = data.partition(b"\n")
+        header = json.loads(header)
+        if header.get("enc") == Encoding.MSGPACK:
+            return cls(header=header, body=body, encoding=Encoding.MSGPACK)
+        return cls(header=header, body=body.decode())
+
+    def frame(self, encoding: Encoding) -> str | bytes:
+        """The body, as a frame for a client using `encoding`."""
+        if encoding == self.encoding:
+            return self.body
+        if encoding not in self._frames:
+            self._frames[encoding] = transcode(self.body, self.encoding, encoding)
+        return self._frames[encoding]
+
+
+def _header(event: Event, encoding: Encoding = Encoding.JSON) -> bytes:
+    # when the event was published, for timing its delivery (see outbox)
+    header: dict[str, typing.Any] = {"event_type": event.event_type, "ts": time.time()}
+    if encoding != Encoding.JSON:
+        header["enc"] = encoding
+    # the fields listeners route on, see Broadcaster._loop
+    match event.event_type:
+        case EventType.GAME_STATE_CHANGE:
+            header["status"] = event.data.status
+        case EventType.MEMBER_LEAVE:
+            header["user_id"] = event.data.user_id
+    return json.dumps(header).encode()
+
+
+def pack(event: Event, encoding: Encoding = Encoding.JSON) -> bytes:
+    """Serialize an event for publishing, prefixed with its routing header."""
+    if encoding == Encoding.MSGPACK:
+        # MessagePack may contain newlines, but only the first one is split on
+        return _header(event, encoding) + b"\n" + dump_model(event, encoding)
+    # model_dump_json never emits a raw newline, so the first one always ends the header
+    return _header(event) + b"\n" + event.model_dump_json().encode()
+
+
+def _seq_key(room_id: str) -> str:
+    return f"room:{room_id}:seq"
+
+
+def log_key(room_id: str) -> str:
+    return f"room:{room_id}:log"
+
+
+async def publish(conn: Redis, room_id: str, event: Event) -> None:
+    """Publish an event to a room's channel.
+
+    Every event but drawings (which are resynced from the canvas snapshot instead) is
+    numbered and appended to the room's event log, so that reconnecting clients can be sent
+    the events they missed. The sequence number is added to the event as `seq`.
+
+    Drawings, the bulk of the traffic, are published in CHANNEL_ENCODING; everything else
+    is JSON.
+    """
+    if event.event_type == EventType.DRAWING:
+        await conn.publish(f"room:{room_id}", pack(event, settings.CHANNEL_ENCODING))
+        return
+    await _log_and_publish(
+        [_seq_key(room_id), log_key(room_id)],
+        [
+            f"room:{room_id}",
+            _header(event),
+            event.model_dump_json(),
+            settings.ROOM_EVENT_LOG_LENGTH,
+            event.event_type,
+        ],
+        client=conn,
+    )
+
+
+async def read_log(
+    conn: Redis, room_id: str, after: int
+) -> tuple[list[tuple[int, str, str]], bool]:
+    """Read the events logged in a room after a sequence number.
+
+    Args:
+        conn: The Redis client to read with.
+        room_id: The room whose log is read.
+        after: The sequence number of the last event already seen.
+
+    Returns:
+        The (sequence number, event type, body) of each logged event, and whether they are every event
+        after `after`, i.e. whether none have been trimmed from the log since.
+    """
+    entries = await conn.xrange(log_key(room_id), min=f"0-{after + 1}")
+    events = [
+        (int(entry_id.split(b"-")[1]), fields[b"type"].decode(), fields[b"body"].decode())
+        for entry_id, fields in entries
+    ]
+    return events, not events or events[0][0] == after + 1
+
+
+async def iter_messages(pubsub: PubSub) -> AsyncIterator[dict[str, typing.Any]]:
+    """Yield published messages from a pub/sub connection as they arrive.
+
+    Reads block until Redis sends something, so an idle connection costs no CPU.
+    If the connection drops, reconnects with exponential backoff; redis-py resubscribes
+    to the previously subscribed channels once the connection is re-established.
+    The iterator ends once the connection has no subscriptions left.
+    """
+    delay = _BACKOFF_INITIAL
+    while pubsub.subscribed:
+        try:
+            message = await typing.cast(
+                typing.Awaitable[dict[str, typing.Any] | None],
+                pubsub.get_message(ignore_subscribe_messages=True, timeout=None),
+            )
+        except ConnectionError:
+            logger.warning(f"Pubsub lost its connection to Redis; reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, _BACKOFF_MAX)
+            continue
+        delay = _BACKOFF_INITIAL
+        if message is not None:
+            yield message
+
+
+class Subscription:
+    """A local subscriber to a channel, registered with a `PubSubHub`.
+
+    Use it as an async context manager, and iterate over it to receive the channel's messages.
+    """
+
+    def __init__(self, hub: "PubSubHub", channel: str, room_id: str | None = None) -> None:
+        self.hub = hub
+        self.channel = channel
+        # set if this is a room's event channel
+        self.room_id = room_id
+        self.queue = asyncio.Queue[Message]()
+
+    async def __aenter__(self) -> "Subscription":
+        await self.hub._add(self)
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        await self.hub._remove(self)
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> Message:
+        return await self.queue.get()
+
+
+RoomObserver = typing.Callable[[str, Message], None]
+# called with a room's ID when this process unsubscribes from its events
+RoomReleaseObserver = typing.Callable[[str], None]
+
+
+class PubSubHub:
+    """Fans out channel messages to every local subscriber.
+
+    A single Redis pub/sub connection is shared by the whole worker process. Each channel
+    (usually a room's) with at least one local subscriber is subscribed to exactly once;
+    every message's routing header is decoded once and the message is handed to each
+    subscriber's queue. The channel is unsubscribed when its last local subscriber leaves.
+
+    While a room's event channel is subscribed to, the hub also keeps the room's snapshot
+    in `room_snapshots` current, and shows the room's events to every room observer. Release
+    observers are told when the room is unsubscribed from.
+    """
+
+    def __init__(self, conn: Redis) -> None:
+        self.conn = conn
+        self._pubsub = conn.pubsub()
+        self._subscriptions = dict[str, set[Subscription]]()
+        # event channel -> room ID, for subscribed rooms
+        self._rooms = dict[str, str]()
+        self._observers = list[RoomObserver]()
+        self._release_observers = list[RoomReleaseObserver]()
+        self._lock = asyncio.Lock()
+        self._reader: asyncio.Task | None = None
+
+    @property
+    def channels(self) -> int:
+        """The number of channels this process is currently subscribed to."""
+        return len(self._subscriptions)
+
+    @property
+    def rooms(self) -> int:
+        """The number of rooms whose events this process is currently subscribed to."""
+        return len(self._rooms)
+
+    def subscribe(self, channel: str) -> Subscription:
+        """Subscribe to a channel. The subscription is active inside its `async with` block."""
+        return Subscription(self, channel)
+
+    def subscribe_room(self, room_id: str) -> Subscription:
+        """Subscribe to a room's events. The subscription is active inside its `async with` block."""
+        return Subscription(self, f"room:{room_id}", room_id=room_id)
+
+    def observe_rooms(self, observer: RoomObserver) -> None:
+        """Call `observer(room_id, message)` with every room event this process receives.
+
+        Observers run inline in the reader task, so they must not block.
+        """
+        self._observers.append(observer)
+
+    def observe_room_releases(self, observer: RoomReleaseObserver) -> None:
+        """Call `observer(room_id)` when this process unsubscribes from a room's events.
+
+        That happens once no socket on this process is in the room any more.
+        """
+        self._release_observers.append(observer)
+
+    def _release(self, room_id: str) -> None:
+        room_snapshots.untrack(room_id)
+        for observer in self._release_observers:
+            try:
+                observer(room_id)
+            except Exception:
+                logger.opt(exception=True).error(
+                    f"PubSubHub: release observer failed on room:{room_id}"
+                )
+
+    async def _add(self, sub: Subscription) -> None:
+        async with self._lock:
+            if sub.channel not in self._subscriptions:
+                await self._pubsub.subscribe(sub.channel)
+                self._subscriptions[sub.channel] = set()
+                if sub.room_id is not None:
+                    self._rooms[sub.channel] = sub.room_id
+                    room_snapshots.track(sub.room_id)
+                logger.info(f"PubSubHub: subscribed to {sub.channel}")
+            self._subscriptions[sub.channel].add(sub)
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._loop(), name="pubsub-hub")
+
+    async def _remove(self, sub: Subscription) -> None:
+        async with self._lock:
+            subs = self._subscriptions.get(sub.channel)
+            if subs is None:
+                return
+            subs.discard(sub)
+            if not subs:
+                del self._subscriptions[sub.channel]
+                if room_id := self._rooms.pop(sub.channel, None):
+                    self._release(room_id)
+                await self._pubsub.unsubscribe(sub.channel)
+                logger.info(f"PubSubHub: unsubscribed from {sub.channel}")
+
+    def _dispatch(self, message: dict[str, typing.Any]) -> None:
+        channel = message["channel"].decode()
+        subs = self._subscriptions.get(channel)
+        if not subs:
+            return
+        parsed = Message.parse(message["data"])
+        if room_id := self._rooms.get(channel):
+            room_snapshots.apply(room_id, parsed.header, parsed.body)
+            for observer in self._observers:
+                # one observer failing shouldn't keep the message from the others
+                try:
+                    observer(room_id, parsed)
+                except Exception:
+                    logger.opt(exception=True).error(f"PubSubHub: observer failed on {channel}")
+        for sub in subs:
+            sub.queue.put_nowait(parsed)
+
+    async def _loop(self) -> None:
+        async for message in iter_messages(self._pubsub):
+            # a malformed message is dropped, rather than ending the reader for every
+            # subscriber on this worker
+            try:
+                self._dispatch(message)
+            except Exception:
+                logger.opt(exception=True).error(
+                    f"PubSubHub: dropped a message on {message.get('channel')!r}"
+                )
+
+    async def aclose(self) -> None:
+        """Stop the reader task and close the shared pub/sub connection."""
+        if self._reader is not None:
+            self._reader.cancel()
+        self._subscriptions.clear()
+        for room_id in self._rooms.values():
+            self._release(room_id)
+        self._rooms.clear()
+        await self._pubsub.aclose()
+
+
+hub = PubSubHub(cache.client)
 
 
 @dataclass
 class Broadcaster:
     ws: WebSocket
     conn: Redis
-    user: User
+    user: UserInfo
     room: Room
+    # the sequence number of the last logged event sent to the client. set by a reconnecting
+    # client, or by `join` for a new one
+    last_seq: int | None = None
+    # whether the client is reconnecting, and should be sent the events it missed as a batch
+    resuming: bool = False
+    # the encoding the client negotiated
+    encoding: Encoding = Encoding.JSON
+    # every frame sent to the client goes through here, see `outbox`
+    outbox: Outbox = field(init=False)
 
-    async def _loop(self, pubsub: PubSub) -> None:
-        connect_tries = 0
-        await pubsub.subscribe(f"room:{self.room.room_id}")
-        while True:
-            try:
-                message = await typing.cast(
-                    typing.Awaitable[dict[str, typing.Any] | None],
-                    pubsub.get_message(ignore_subscribe_messages=True),
-                )
-            except ConnectionError:
-                connect_tries += 1
-                if connect_tries == 50:
-                    logger.warning(
-                        "Pubsub could not connect to Redis after 50 retries. Is redis running?"
-                    )
-                    return
-                else:
+    def __post_init__(self) -> None:
+        self.outbox = Outbox(
+            self.ws, settings.OUTBOUND_QUEUE_SIZE, settings.OUTBOUND_QUEUE_MAX_LAG, self.encoding
+        )
+
+    async def _send(
+        self, event_type: str, frame: str | bytes, published: float | None = None
+    ) -> bool:
+        """Queue a frame for the client, disconnecting it if it's too far behind.
+
+        Returns:
+            Whether the client is still connected.
+        """
+        if self.outbox.evicted:
+            return False
+        if self.outbox.put(event_type, frame, published):
+            return True
+        logger.warning(f"{self.user.username} in room:{self.room.room_id} is too far behind")
+        await self.outbox.evict()
+        return False
+
+    async def _loop(self, events: Subscription) -> None:
+        async for message in events:
+            header = message.header
+            # skip events already sent while catching up
+            if (seq := header.get("seq")) is not None:
+                if self.last_seq is not None and seq <= self.last_seq:
                     continue
-            if message is not None:
-                event = json.loads(message["data"])
-                event_type = EventType(event["event_type"])
-                # the listener should stop in two cases:
-                # either the game has ended (event["data"]["status"] == "ended")
-                if event_type == EventType.GAME_STATE_CHANGE and event["data"]["status"] == "ended":
-                    # in this case, emit the event and then end the loop
-                    await self.ws.send_json(event)
-                    return
-                # OR the current user has left the room (event_type = MEMBER_LEAVE and
-                # event["data"]["user_id"] == self.user.id).
-                # in this case we do not have to emit the event to this user
-                elif event_type == EventType.MEMBER_LEAVE and event["data"]["user_id"] == str(
-                    self.user.id
-                ):
-                    return
-                await self.ws.send_json(event)
+                self.last_seq = seq
+            # the listener should stop in two cases:
+            # either the game has ended (header["status"] == "ended")
+            if (
+                header["event_type"] == EventType.GAME_STATE_CHANGE
+                and header["status"] == GameStatus.ENDED
+            ):
+                # in this case, emit the event and then end the loop
+                await self._send(
+                    header["event_type"], message.frame(self.encoding), header.get("ts")
+                )
+                return
+            # OR the current user has left the room (event_type = MEMBER_LEAVE and
+            # header["user_id"] == self.user.id).
+            # in this case we do not have to emit the event to this user
+            elif header["event_type"] == EventType.MEMBER_LEAVE and header["user_id"] == str(
+                self.user.id
+            ):
+                self.outbox.clear()
+                return
+            if not await self._send(
+                header["event_type"], message.frame(self.encoding), header.get("ts")
+            ):
+                return
 
-    async def listen(self) -> None:
-        """Subscribe to the room's channel on Redis, and send the received messages over the websocket."""
-        async with self.conn.pubsub() as pubsub:
-            task = asyncio.create_task(
-                self._loop(pubsub), name=f"room:{self.room.room_id}:user:{self.user.id}"
+    async def _catch_up(self) -> None:
+        """Send the client the logged events after `last_seq`."""
+        if self.last_seq is None:
+            return
+        events, complete = await read_log(self.conn, self.room.room_id, self.last_seq)
+        if self.resuming and self.encoding == Encoding.JSON:
+            # the bodies are already JSON, so the batch is put together as text
+            bodies = ",".join(body for *_, body in events)
+            await self._send(
+                EventType.REPLAY,
+                f'{{"event_type":"{EventType.REPLAY}","data":'
+                f'{{"complete":{json.dumps(complete)},"events":[{bodies}]}}}}',
             )
-            _bg_tasks.add(task)
-            task.add_done_callback(_bg_tasks.discard)
+        elif self.resuming:
+            replay = {
+                "event_type": EventType.REPLAY,
+                "data": {"complete": complete, "events": [json.loads(body) for *_, body in events]},
+            }
+            await self._send(EventType.REPLAY, dumps(replay, self.encoding))
+        else:
+            for _, event_type, body in events:
+                await self._send(event_type, transcode(body, Encoding.JSON, self.encoding))
+        if events:
+            self.last_seq = events[-1][0]
+
+    async def listen(self) -> None:
+        """Subscribe to the room's channel through the hub, and send the received messages over the websocket.
+
+        Logged events published since `last_seq` but before the subscription started are
+        sent first, so none are lost between `join` and `listen`. Frames are sent by the
+        outbox's writer task, which is stopped once the client stops listening.
+        """
+        self.outbox.start()
+        try:
+            async with hub.subscribe_room(self.room.room_id) as events:
+                await self._catch_up()
+                await self._loop(events)
+        finally:
+            await self.outbox.close()
 
     async def emit(self, event: Event) -> None:
         """Emit an event to the pubsub channel, to be picked up by all subscribers."""
-        await self.conn.publish(f"room:{self.room.room_id}", event.model_dump_json())
+        await publish(self.conn, self.room.room_id, event)
 
     async def send_personal(self, event: Event) -> None:
         """Send an event to only the websocket client associated with this broadcaster."""
-        await self.ws.send_json(event.model_dump())
+        await self._send(event.event_type, dump_model(event, self.encoding))
 
     async def join(self) -> None:
-        """Sends a CONNECT event to the newly joined client, and a MEMBER_JOIN event to everyone else."""
+        """Sends a CONNECT event to the newly joined client, and a MEMBER_JOIN event to everyone else.
+
+        If a turn is being drawn, the client is also sent the canvas so far.
+        """
+        async with self.conn.pipeline(transaction=False) as pipe:
+            pipe.get(snapshot_key(self.room.room_id))
+            pipe.get(_seq_key(self.room.room_id))
+            canvas, seq = await pipe.execute()
         await self.send_personal(ConnectEvent(data=self.room))
+        if canvas is not None:
+            snapshot = transcode(decode_snapshot(canvas), Encoding.JSON, self.encoding)
+            await self._send(EventType.DRAWING, snapshot)
+        if self.last_seq is None:
+            # the CONNECT event reflects every event up to here
+            self.last_seq = int(seq or 0)
         await self.emit(MemberJoinEvent(data=_db_user_to_game_member(self.user)))
 
     async def leave(self) -> None:
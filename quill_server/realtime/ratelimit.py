@@ -0,0 +1,217 @@
+"""Rate limits on the frames clients send over room sockets."""
+import asyncio
+import math
+import time
+import typing
+from collections.abc import Awaitable, Callable
+
+from redis.asyncio import Redis
+
+from quill_server import cache
+from quill_server.config import settings
+from quill_server.realtime.canvas import Canvas
+from quill_server.realtime.events import EventType, ExcalidrawElement
+
+
+# take up to ARGV[3] tokens from the bucket KEYS[1], which refills by ARGV[1] tokens a second
+# up to ARGV[2]. returns the number taken
+_LEASE = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local rate, burst, wanted = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "at")
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - at) * rate)
+local taken = math.min(wanted, math.floor(tokens))
+redis.call("HSET", KEYS[1], "tokens", tokens - taken, "at", string.format("%.6f", now))
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return taken
+"""
+
+_lease = cache.client.register_script(_LEASE)
+
+# a worker leases this fraction of a room bucket's burst at a time, so a room's limit costs a
+# round trip to Redis per batch of frames rather than per frame
+_LEASE_FRACTION = 0.1
+# how often a socket is told that its frames of one event type are being dropped, in seconds.
+# drawings aren't dropped but held back, and coalesced into the next one let through
+_WARN_INTERVAL = 1.0
+_EVENT_TYPES = frozenset(EventType)
+
+
+def _kind(event_type: str) -> str:
+    # event types come from clients, and mustn't make up keys of their own
+    return event_type if event_type in _EVENT_TYPES else "*"
+
+
+def _limits(limits: dict[str, tuple[float, int]], event_type: str) -> tuple[float, int]:
+    return limits.get(event_type) or limits["*"]
+
+
+class TokenBucket:
+    """An in-process token bucket.
+
+    Args:
+        rate: The tokens added a second.
+        burst: The most tokens the bucket holds; it starts full.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> bool:
+        """Take a token, if there is one."""
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait(self) -> float:
+        """How long until there is a token, in seconds."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RoomAllowance:
+    """Tokens for one event type, leased in batches from a room's bucket in Redis."""
+
+    def __init__(self, conn: Redis, room_id: str, event_type: str) -> None:
+        self.conn = conn
+        self.key = f"room:{room_id}:rate:{event_type}"
+        self.rate, self.burst = _limits(settings.ROOM_RATE_LIMITS, event_type)
+        self.batch = max(1, math.floor(self.burst * _LEASE_FRACTION))
+        self.tokens = 0
+        # the room's bucket was empty; don't ask again before this
+        self.retry_at = 0.0
+
+    async def take(self) -> bool:
+        """Take a token, leasing more from Redis if none are left here."""
+        if self.tokens:
+            self.tokens -= 1
+            return True
+        now = time.monotonic()
+        if now < self.retry_at:
+            return False
+        leased = await typing.cast(
+            typing.Awaitable[int],
+            _lease([self.key], [self.rate, self.burst, self.batch], client=self.conn),
+        )
+        if not leased:
+            self.retry_at = now + 1 / self.rate
+            return False
+        self.tokens = leased - 1
+        return True
+
+
+# room ID -> (the number of local sockets in it, event type -> its allowance)
+_rooms = dict[str, tuple[int, dict[str, RoomAllowance]]]()
+
+
+class RateLimiter:
+    """Limits the frames one socket sends, by the user's own limits, then the room's.
+
+    The user's limits are token buckets per event type kept in-process; the room's are buckets
+    in Redis shared by the workers with sockets in the room.
+
+    Args:
+        conn: The Redis client.
+        room_id: The room the socket is in.
+        release: Called with held back drawing elements once the limits let them through.
+    """
+
+    def __init__(
+        self,
+        conn: Redis,
+        room_id: str,
+        release: Callable[[list[ExcalidrawElement]], Awaitable[None]],
+    ) -> None:
+        self.conn = conn
+        self.room_id = room_id
+        self.release = release
+        # event type -> bucket
+        self._buckets = dict[str, TokenBucket]()
+        # event type -> when the client was last told its frames were dropped
+        self._warned = dict[str, float]()
+        self._held: Canvas | None = None
+        self._releaser: asyncio.Task | None = None
+        sockets, allowances = _rooms.get(room_id, (0, {}))
+        _rooms[room_id] = (sockets + 1, allowances)
+        self._allowances = allowances
+
+    async def allow(self, event_type: str) -> bool:
+        """Whether a frame may be sent, using up a token from each limit if so."""
+        event_type = _kind(event_type)
+        bucket = self._buckets.get(event_type)
+        if bucket is None:
+            bucket = self._buckets[event_type] = TokenBucket(
+                *_limits(settings.USER_RATE_LIMITS, event_type)
+            )
+        if not bucket.take():
+            return False
+        allowance = self._allowances.get(event_type)
+        if allowance is None:
+            allowance = self._allowances[event_type] = RoomAllowance(
+                self.conn, self.room_id, event_type
+            )
+        return await allowance.take()
+
+    def should_warn(self, event_type: str) -> bool:
+        """Whether to tell the client its frames of a type are being dropped; rate limited too."""
+        event_type = _kind(event_type)
+        now = time.monotonic()
+        if now - self._warned.get(event_type, -math.inf) < _WARN_INTERVAL:
+            return False
+        self._warned[event_type] = now
+        return True
+
+    def hold(self, elements: list[ExcalidrawElement]) -> None:
+        """Hold back validated drawing elements until the limits let them through."""
+        if self._held is None:
+            self._held = Canvas()
+        self._held.apply(elements)
+        if self._releaser is None:
+            self._releaser = asyncio.create_task(self._release_held())
+
+    def merge_held(self, elements: list[ExcalidrawElement]) -> list[ExcalidrawElement]:
+        """Add the elements held back to a validated drawing that's being let through."""
+        if self._held is None:
+            return elements
+        held, self._held = self._held, None
+        held.apply(elements)
+        if self._releaser is not None:
+            self._releaser.cancel()
+            self._releaser = None
+        return list(held.elements.values())
+
+    async def _release_held(self) -> None:
+        bucket = self._buckets[EventType.DRAWING]
+        while True:
+            await asyncio.sleep(bucket.wait())
+            if await self.allow(EventType.DRAWING):
+                break
+            # the room is over its limit; try again once it has likely refilled
+            await asyncio.sleep(1 / _limits(settings.ROOM_RATE_LIMITS, EventType.DRAWING)[0])
+        self._releaser = None
+        if self._held is not None:
+            held, self._held = self._held, None
+            await self.release(list(held.elements.values()))
+
+    def close(self) -> None:
+        """Stop limiting; held back drawing elements are dropped."""
+        if self._releaser is not None:
+            self._releaser.cancel()
+        sockets, allowances = _rooms.pop(self.room_id, (1, {}))
+        if sockets > 1:
+            _rooms[self.room_id] = (sockets - 1, allowances)
@@ -1,3 +1,4 @@
+import time
 import typing
 from enum import StrEnum, auto
 from json import loads
@@ -6,9 +7,14 @@ from uuid import uuid4, UUID
 from fastapi import Path
 from loguru import logger
 from pydantic import BaseModel
+from redis.asyncio import Redis
 
 from quill_server import cache
-from quill_server.db.models import User
+from quill_server.config import settings
+from quill_server.schema import UserInfo
+from quill_server.realtime.lifecycle import touch
+from quill_server.realtime.lobby import CAPACITY, OPEN_ROOMS, REINDEX, reindex
+from quill_server.realtime.turn import SIGNALS, check_turn_complete, start_signal
 
 
 class GameStatus(StrEnum):
@@ -46,10 +52,105 @@ class ChatMessage(BaseModel):
     has_guessed: bool
 
 
-def _db_user_to_game_member(user: User) -> GameMember:
+def _db_user_to_game_member(user: UserInfo) -> GameMember:
     return GameMember(user_id=str(user.id), username=user.username)
 
 
+# appends the room's members to `result`, in the order they joined, as user ID, username
+_LIST_MEMBERS = """
+local function list_members(result)
+    for _, user_id in ipairs(redis.call("ZRANGE", KEYS[3], 0, -1)) do
+        local username = redis.call("HGET", KEYS[2], user_id)
+        if username then
+            table.insert(result, user_id)
+            table.insert(result, username)
+        end
+    end
+    return result
+end
+"""
+
+
+# the keys the join and leave scripts are given: room:{id}:status, room:{id}:members,
+# room:{id}:order, room:{id}:departed, room:{id}:seats, and the quick-join index
+def _keys(room_id: str) -> list[str]:
+    key = f"room:{room_id}"
+    return [
+        f"{key}:status",
+        f"{key}:members",
+        f"{key}:order",
+        f"{key}:departed",
+        f"{key}:seats",
+        OPEN_ROOMS,
+    ]
+
+
+# add user ARGV[1] named ARGV[2] to room ARGV[6], scored ARGV[3] in the join order, if they
+# may join: they aren't in it already, the game is in its lobby (or ongoing, if ARGV[4] is
+# "1" and they're coming back to it), and there's a seat for them out of ARGV[5], not
+# counting those reserved by others. returns {"", status, members...}, or {reason} if they
+# may not
+_JOIN = (
+    REINDEX
+    + _LIST_MEMBERS
+    + """
+local user, capacity, room_id = ARGV[1], tonumber(ARGV[5]), ARGV[6]
+local key = "room:" .. room_id
+-- reject connection if the user is already in the room...
+if redis.call("HEXISTS", KEYS[2], user) == 1 then
+    return {"User is already in this room"}
+end
+-- or if the game isn't in the lobby state anymore, unless they're coming back to it...
+local status = redis.call("GET", KEYS[1])
+if status ~= "lobby" and not (
+    ARGV[4] == "1" and status == "ongoing" and redis.call("SISMEMBER", KEYS[4], user) == 1
+) then
+    return {"Room is no longer accepting members"}
+end
+-- or if the room is full, counting seats reserved by quick-joining players
+local fill = reindex(KEYS[6], key, room_id, capacity)
+if redis.call("ZSCORE", KEYS[5], user) then
+    fill = fill - 1
+end
+if fill >= capacity then
+    return {"Maximum room capacity reached"}
+end
+redis.call("HSET", KEYS[2], user, ARGV[2])
+redis.call("ZADD", KEYS[3], "NX", ARGV[3], user)
+redis.call("SREM", KEYS[4], user)
+-- the seat the user may have reserved is now taken
+redis.call("ZREM", KEYS[5], user)
+reindex(KEYS[6], key, room_id, capacity)
+return list_members({"", status})
+"""
+)
+
+# remove user ARGV[1] from room ARGV[3], with capacity ARGV[2], remembering them so they may
+# rejoin if they were only disconnected. returns {whether they were in it, status, members...}
+_LEAVE = (
+    REINDEX
+    + _LIST_MEMBERS
+    + """
+local user, room_id = ARGV[1], ARGV[3]
+local removed = redis.call("HDEL", KEYS[2], user)
+redis.call("ZREM", KEYS[3], user)
+redis.call("SADD", KEYS[4], user)
+reindex(KEYS[6], "room:" .. room_id, room_id, tonumber(ARGV[2]))
+return list_members({removed, redis.call("GET", KEYS[1]) or ""})
+"""
+)
+
+_join = cache.client.register_script(_JOIN)
+_leave = cache.client.register_script(_LEAVE)
+
+
+def _member_list(flat: list[bytes]) -> list[GameMember]:
+    return [
+        GameMember(user_id=user_id.decode(), username=username.decode())
+        for user_id, username in zip(flat[::2], flat[1::2], strict=True)
+    ]
+
+
 class Room(BaseModel):
     """Represents a Quill game room."""
 
@@ -59,7 +160,7 @@ class Room(BaseModel):
     status: GameStatus
 
     @classmethod
-    def new(cls: type["Room"], owner: User) -> "Room":
+    def new(cls: type["Room"], owner: UserInfo) -> "Room":
         return cls(
             room_id=str(uuid4()),
             owner=_db_user_to_game_member(owner),
@@ -71,84 +172,248 @@ class Room(BaseModel):
         """Start the game in this room."""
         self.status = GameStatus.ONGOING
         logger.info(f"Setting room:{self.room_id}:status = ONGOING")
-        await cache.client.set(f"room:{self.room_id}:status", str(self.status))
+        async with cache.client.pipeline(transaction=True) as pipe:
+            pipe.set(f"room:{self.room_id}:status", str(self.status))
+            # takes the room out of the quick-join index
+            await reindex(pipe, self.room_id)
+            # wakes up the turn engine running this room, on whichever worker that is
+            pipe.publish(SIGNALS, start_signal(self.room_id))
+            await pipe.execute()
+        # setting the status cleared its expiry
+        await touch(cache.client, self.room_id)
 
     async def end(self) -> None:
         """End the game in this room."""
         self.status = GameStatus.ENDED
         logger.info(f"Setting room:{self.room_id}:status = ENDED")
-        await cache.client.set(f"room:{self.room_id}:status", str(self.status))
-
-    async def join(self, user: User) -> None:
-        """Add a user to this room."""
-        # reject connection if the user is already in the room...
-        if any([u.user_id == str(user.id) for u in self.users]):
-            raise ValueError("User is already in this room")
-        # or if the game isn't in the lobby state anymore...
-        elif self.status != GameStatus.LOBBY:
-            raise ValueError("Room is no longer accepting members")
-        # or if the room already has 8 members
-        elif len(self.users) == 8:
-            raise ValueError("Maximum room capacity reached")
+        async with cache.client.pipeline(transaction=True) as pipe:
+            pipe.set(f"room:{self.room_id}:status", str(self.status))
+            await reindex(pipe, self.room_id)
+            await pipe.execute()
+
+    async def join(self, user: UserInfo, rejoining: bool = False) -> None:
+        """Add a user to this room.
+
+        The checks and the write happen in one script, so concurrent joins can't overfill
+        the room or add a user twice. The room's members and status are updated from Redis,
+        including the new member.
+
+        Args:
+            user: The user joining.
+            rejoining: Whether the user is reconnecting after losing their connection. Users who
+                left an ongoing game may rejoin it.
+
+        Raises:
+            ValueError: The user may not join the room.
+        """
         data = _db_user_to_game_member(user)
-        self.users.append(data)
         logger.info(f"Adding {data.username} to room:{self.room_id}")
-        await typing.cast(
-            typing.Awaitable[int],
-            cache.client.rpush(f"room:{self.room_id}:users", data.model_dump_json()),
+        args = [
+            data.user_id,
+            data.username,
+            time.time(),
+            "1" if rejoining else "0",
+            CAPACITY,
+            self.room_id,
+        ]
+        reason, *rest = await typing.cast(
+            typing.Awaitable[list[bytes]], _join(_keys(self.room_id), args, client=cache.client)
         )
+        if reason:
+            raise ValueError(reason.decode())
+        status, *members = rest
+        self.status = GameStatus(status.decode())
+        self.users = _member_list(members)
+        await touch(cache.client, self.room_id)
 
-    async def leave(self, user: User) -> None:
-        """Remove a user from this room."""
+    async def leave(self, user: UserInfo) -> None:
+        """Remove a user from this room, updating its members and status from Redis."""
         data = _db_user_to_game_member(user)
-        self.users.remove(data)
         logger.info(f"Removing {data.username} from room:{self.room_id}")
-        res = await typing.cast(
-            typing.Awaitable[int],
-            cache.client.lrem(f"room:{self.room_id}:users", 1, data.model_dump_json()),
+        res, status, *members = await typing.cast(
+            typing.Awaitable[list[typing.Any]],
+            _leave(
+                _keys(self.room_id), [data.user_id, CAPACITY, self.room_id], client=cache.client
+            ),
         )
+        if status:
+            self.status = GameStatus(status.decode())
+        self.users = _member_list(members)
         if res != 1:
             logger.warning(
                 f"Attempted removing {data.username} from room:{self.room_id} "
                 f"but Redis gave a response != 1 ({res=})"
             )
+        # the members still in the room may all have guessed the current answer already
+        await check_turn_complete(cache.client, self.room_id)
 
     async def to_redis(self) -> None:
         """Writes the room to Redis."""
-        # all the dictionaries are being dumped to redis as JSON strings
-        # room:id:users will be a list of JSON strings
+        # the owner is dumped to redis as a JSON string. members are stored as a hash of
+        # user ID -> username (room:id:members), and a sorted set of user IDs scored by
+        # when they joined (room:id:order)
         key = f"room:{self.room_id}"
         owner = self.owner.model_dump_json()
-        users = [i.model_dump_json() for i in self.users]
         status = str(self.status)
         logger.info(f"Writing {key} to Redis")
         async with cache.client.pipeline(transaction=True) as pipe:
             pipe.set(f"{key}:owner", owner)
             pipe.set(f"{key}:status", str(status))
-            if len(users) > 0:
-                pipe.rpush(f"{key}:users", *users)
+            if len(self.users) > 0:
+                now = time.time()
+                pipe.hset(f"{key}:members", mapping={u.user_id: u.username for u in self.users})
+                pipe.zadd(f"{key}:order", {u.user_id: now + i for i, u in enumerate(self.users)})
+            await reindex(pipe, self.room_id)
             await pipe.execute()
+        await touch(cache.client, self.room_id)
         logger.info(f"Saved {key} to Redis")
 
     @classmethod
     async def from_redis(cls: type["Room"], room_id: str) -> typing.Optional["Room"]:
         key = f"room:{room_id}"
         logger.info(f"Fetching {key} from Redis")
-        status = await cache.client.get(f"{key}:status")
+        # read all of the room's keys atomically, in one round trip
+        async with cache.client.pipeline(transaction=True) as pipe:
+            pipe.get(f"{key}:status")
+            pipe.get(f"{key}:owner")
+            pipe.zrange(f"{key}:order", 0, -1)
+            pipe.hgetall(f"{key}:members")
+            pipe.exists(f"{key}:users")
+            status, owner_res, order, members, legacy = await pipe.execute()
         if not status:
             logger.warning(f"{key} does not exist in cache")
             return
-        owner_res = await cache.client.get(f"{key}:owner")
+        if legacy:
+            await migrate_members(room_id)
+            return await cls.from_redis(room_id)
         owner = loads(owner_res)
-        # redis-py has incorrect return types set, so we need to cast here
-        # https://github.com/redis/redis-py/issues/2933
-        users_res = await typing.cast(
-            typing.Awaitable[list[bytes]], cache.client.lrange(f"{key}:users", 0, -1)
-        )
-        users = [loads(i) for i in users_res]
+        users = _ordered_members(order, members)
         return cls(room_id=room_id, owner=owner, users=users, status=status.decode())
 
 
+def _ordered_members(order: list[bytes], members: dict[bytes, bytes]) -> list[GameMember]:
+    return [
+        GameMember(user_id=i.decode(), username=members[i].decode()) for i in order if i in members
+    ]
+
+
+async def get_members(conn: Redis, room_id: str) -> list[GameMember]:
+    """Get a room's members, in the order they joined."""
+    async with conn.pipeline(transaction=True) as pipe:
+        pipe.zrange(f"room:{room_id}:order", 0, -1)
+        pipe.hgetall(f"room:{room_id}:members")
+        order, members = await pipe.execute()
+    return _ordered_members(order, members)
+
+
+# rooms created before members were stored in a hash kept them in room:{id}:users,
+# a list of GameMember JSON strings. this moves such a list into the members hash
+# and join order set, keeping the order, and deletes it.
+# KEYS: room:{id}:users, room:{id}:members, room:{id}:order
+_MIGRATE_MEMBERS = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'list' then
+    return 0
+end
+local users = redis.call('LRANGE', KEYS[1], 0, -1)
+for i, raw in ipairs(users) do
+    local member = cjson.decode(raw)
+    redis.call('HSET', KEYS[2], member.user_id, member.username)
+    redis.call('ZADD', KEYS[3], 'NX', i, member.user_id)
+end
+redis.call('DEL', KEYS[1])
+return #users
+"""
+
+_migrate_members = cache.client.register_script(_MIGRATE_MEMBERS)
+
+
+async def migrate_members(room_id: str) -> int:
+    """Move a room's members from the legacy list layout to the members hash.
+
+    Returns:
+        The number of members migrated.
+    """
+    key = f"room:{room_id}"
+    n = await typing.cast(
+        typing.Awaitable[int],
+        _migrate_members([f"{key}:users", f"{key}:members", f"{key}:order"]),
+    )
+    if n:
+        logger.info(f"Migrated {n} members of {key} to the members hash")
+    return n
+
+
+class RoomSnapshots:
+    """A per-process cache of rooms, kept current by each room's own pub/sub events.
+
+    Only rooms whose channel this process is subscribed to are cached (the pub/sub hub
+    tracks and untracks them), since only those receive the MEMBER_JOIN, MEMBER_LEAVE and
+    GAME_STATE_CHANGE events that keep a snapshot up to date. Applying those events is
+    idempotent, so a snapshot read while they are in flight converges. Snapshots are also
+    reloaded once they are older than `max_age` seconds; a `max_age` of 0 disables the cache.
+    """
+
+    def __init__(self, max_age: float) -> None:
+        self.max_age = max_age
+        self._tracked = set[str]()
+        # room ID -> (time loaded, room)
+        self._rooms = dict[str, tuple[float, Room]]()
+
+    def track(self, room_id: str) -> None:
+        if self.max_age > 0:
+            self._tracked.add(room_id)
+
+    def untrack(self, room_id: str) -> None:
+        self._tracked.discard(room_id)
+        self._rooms.pop(room_id, None)
+
+    def get(self, room_id: str) -> Room | None:
+        entry = self._rooms.get(room_id)
+        if entry is None:
+            return None
+        loaded_at, room = entry
+        if time.monotonic() - loaded_at > self.max_age:
+            del self._rooms[room_id]
+            return None
+        # callers mutate the rooms they're given, so hand out copies
+        return room.model_copy(deep=True)
+
+    def put(self, room: Room) -> None:
+        if room.room_id in self._tracked:
+            self._rooms[room.room_id] = (time.monotonic(), room.model_copy(deep=True))
+
+    def apply(self, room_id: str, header: dict[str, typing.Any], body: str) -> None:
+        """Update a room's snapshot with an event published on its channel."""
+        entry = self._rooms.get(room_id)
+        if entry is None:
+            return
+        room = entry[1]
+        match header["event_type"]:
+            case "member_join":
+                member = GameMember.model_validate(loads(body)["data"])
+                if member not in room.users:
+                    room.users.append(member)
+            case "member_leave":
+                room.users = [u for u in room.users if u.user_id != header["user_id"]]
+            case "game_state_change":
+                # only the status; the members in the event may be older than the snapshot's
+                status = header.get("status") or loads(body)["data"]["status"]
+                room.status = GameStatus(status)
+
+
+room_snapshots = RoomSnapshots(max_age=settings.ROOM_SNAPSHOT_MAX_AGE)
+
+
+async def get_room(room_id: str) -> Room | None:
+    """Get a room, from this process' snapshot if there is one, or from Redis otherwise."""
+    if room := room_snapshots.get(room_id):
+        return room
+    room = await Room.from_redis(room_id)
+    if room:
+        room_snapshots.put(room)
+    return room
+
+
 # ruff complains about the Path() call, but this is FastAPI convention
 async def get_current_room(room_id: UUID = Path(...)) -> Room | None:  # noqa: B008
-    return await Room.from_redis(str(room_id))
+    return await get_room(str(room_id))
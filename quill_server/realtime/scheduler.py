@@ -0,0 +1,196 @@
+"""Scheduling of game loops across workers, through leases in Redis."""
+import asyncio
+import contextlib
+import typing
+from uuid import uuid4
+
+from loguru import logger
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from quill_server import cache
+from quill_server.config import settings
+from quill_server.realtime.game_loop import TurnEngine
+
+
+# room ID -> lease expiry, in milliseconds of Redis server time. workers claim rooms whose
+# lease has expired (new rooms start out expired), so that if a worker goes away, its rooms
+# are taken over within a lease period and their games resume from the turn they were on
+_LEASES = "game_loops"
+# room ID -> ID of the worker holding its lease
+_OWNERS = "game_loops:owners"
+
+# leases are timed by the Redis server's clock, so that workers' clocks needn't agree
+_NOW = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+"""
+
+# claim up to ARGV[3] rooms whose leases have expired for worker ARGV[2], for ARGV[1] ms
+_CLAIM = (
+    _NOW
+    + """
+local rooms = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", now, "LIMIT", 0, ARGV[3])
+for _, room in ipairs(rooms) do
+    redis.call("ZADD", KEYS[1], now + ARGV[1], room)
+    redis.call("HSET", KEYS[2], room, ARGV[2])
+end
+return rooms
+"""
+)
+
+# extend worker ARGV[2]'s leases on the rooms ARGV[3:] by ARGV[1] ms. returns the rooms
+# whose leases it no longer holds
+_RENEW = (
+    _NOW
+    + """
+local lost = {}
+for i = 3, #ARGV do
+    local room = ARGV[i]
+    if redis.call("HGET", KEYS[2], room) == ARGV[2] then
+        redis.call("ZADD", KEYS[1], "XX", now + ARGV[1], room)
+    else
+        table.insert(lost, room)
+    end
+end
+return lost
+"""
+)
+
+# give up worker ARGV[2]'s lease on room ARGV[3]. if ARGV[1] is "1" the room's loop has
+# finished and it is unscheduled, otherwise it is left for a worker to claim in ARGV[4] ms
+_RELEASE = (
+    _NOW
+    + """
+if redis.call("HGET", KEYS[2], ARGV[3]) ~= ARGV[2] then
+    return 0
+end
+redis.call("HDEL", KEYS[2], ARGV[3])
+if ARGV[1] == "1" then
+    redis.call("ZREM", KEYS[1], ARGV[3])
+else
+    redis.call("ZADD", KEYS[1], "XX", now + ARGV[4], ARGV[3])
+end
+return 1
+"""
+)
+
+_claim = cache.client.register_script(_CLAIM)
+_renew = cache.client.register_script(_RENEW)
+_release = cache.client.register_script(_RELEASE)
+
+
+class GameLoopScheduler:
+    """Claims rooms through leases in Redis, and runs their games in a turn engine.
+
+    Args:
+        conn: The Redis client.
+        engine: The turn engine running this worker's rooms.
+        max_loops: The most game loops this worker runs at once.
+        lease_ttl: How long a lease lasts without being renewed, in seconds. Leases are
+            renewed every third of this.
+    """
+
+    def __init__(self, conn: Redis, engine: TurnEngine, max_loops: int, lease_ttl: float) -> None:
+        self.conn = conn
+        self.engine = engine
+        self.engine.on_finished = self._finished
+        self.max_loops = max_loops
+        self.lease_ttl = lease_ttl
+        self.worker_id = uuid4().hex
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._releases = set[asyncio.Task]()
+
+    @property
+    def _keys(self) -> list[str]:
+        return [_LEASES, _OWNERS]
+
+    async def schedule(self, room_id: str) -> None:
+        """Schedule a room's game loop to be run by some worker."""
+        await self.conn.zadd(_LEASES, {room_id: 0}, nx=True)
+        # this worker may well have room for it, so check now rather than on the next tick
+        self._wake.set()
+
+    async def _claim(self) -> None:
+        free = self.max_loops - len(self.engine.rooms)
+        if free <= 0:
+            return
+        ttl = int(self.lease_ttl * 1000)
+        rooms = await typing.cast(
+            typing.Awaitable[list[bytes]],
+            _claim(self._keys, [ttl, self.worker_id, free], client=self.conn),
+        )
+        for room in rooms:
+            room_id = room.decode()
+            logger.info(f"Scheduler: claimed room:{room_id}")
+            self.engine.add(room_id)
+
+    async def _renew(self) -> None:
+        if not self.engine.rooms:
+            return
+        ttl = int(self.lease_ttl * 1000)
+        lost = await typing.cast(
+            typing.Awaitable[list[bytes]],
+            _renew(self._keys, [ttl, self.worker_id, *self.engine.rooms], client=self.conn),
+        )
+        for room in lost:
+            room_id = room.decode()
+            # another worker took the room over, probably because this one stalled
+            logger.warning(f"Scheduler: lost the lease on room:{room_id}; stopping its loop")
+            self.engine.remove(room_id)
+
+    def _finished(self, room_id: str, done: bool) -> None:
+        if done:
+            release = self._release(room_id, done=True)
+        else:
+            # handed back a lease period from now, so that a loop that keeps failing isn't
+            # retried as fast as workers can claim it
+            logger.warning(f"Scheduler: room:{room_id}'s loop failed; handing it back")
+            release = self._release(room_id, done=False, retry_after=self.lease_ttl)
+        task = asyncio.create_task(release)
+        self._releases.add(task)
+        task.add_done_callback(self._releases.discard)
+        # a slot just opened up
+        self._wake.set()
+
+    async def _release(self, room_id: str, done: bool, retry_after: float = 0) -> None:
+        args = ["1" if done else "0", self.worker_id, room_id, int(retry_after * 1000)]
+        await _release(self._keys, args, client=self.conn)
+
+    async def _run(self) -> None:
+        interval = self.lease_ttl / 3
+        while True:
+            self._wake.clear()
+            if not self.engine.running:
+                # holding on to leases for rooms nobody is advancing would stall their games
+                logger.warning("Scheduler: the turn engine isn't running; restarting it")
+                await self.engine.start()
+            try:
+                await self._renew()
+                await self._claim()
+            except RedisError as e:
+                logger.warning(f"Scheduler: couldn't renew or claim leases: {e}")
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), timeout=interval)
+
+    async def start(self) -> None:
+        """Start claiming rooms and running their loops."""
+        logger.info(f"Scheduler: starting as worker {self.worker_id}")
+        await self.engine.start()
+        self._task = asyncio.create_task(self._run(), name="game-loop-scheduler")
+
+    async def stop(self) -> None:
+        """Stop this worker's loops, and hand their rooms over to other workers."""
+        if self._task is not None:
+            self._task.cancel()
+        for room_id in await self.engine.stop():
+            await self._release(room_id, done=False)
+
+
+scheduler = GameLoopScheduler(
+    cache.client,
+    TurnEngine(cache.client),
+    max_loops=settings.GAME_LOOP_MAX_PER_WORKER,
+    lease_ttl=settings.GAME_LOOP_LEASE_TTL,
+)
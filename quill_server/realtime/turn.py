@@ -0,0 +1,202 @@
+"""Guess evaluation and turn completion signalling."""
+import json
+import typing
+from collections import Counter
+from enum import IntEnum
+from functools import lru_cache
+
+from loguru import logger
+from redis.asyncio import Redis
+
+from quill_server import cache
+
+# the channel turn engines listen on for game start and turn completion notices. notices for
+# every room go to this one channel, so that a worker's turn engine needs a single subscription
+# however many rooms it runs; engines ignore the rooms they aren't running
+SIGNALS = "turns"
+
+# shared by the scripts below. the code paths that can complete a turn (a correct guess, or a
+# member leaving) check and publish atomically, rather than the turn engine polling for it.
+# KEYS: room:{id}:guessed, room:{id}:members, room:{id}:turn
+# ARGV[1]: the signals channel, ARGV[2]: the room ID
+_PUBLISH_IF_COMPLETE = """
+local function publish_if_complete()
+    local turn = redis.call('GET', KEYS[3])
+    if not turn then
+        return 0
+    end
+    if redis.call('SCARD', KEYS[1]) >= redis.call('HLEN', KEYS[2]) then
+        redis.call('PUBLISH', ARGV[1], cjson.encode({room_id = ARGV[2], turn = turn}))
+        return 1
+    end
+    return 0
+end
+"""
+
+_CHECK_TURN_COMPLETE = (
+    _PUBLISH_IF_COMPLETE
+    + """
+return publish_if_complete()
+"""
+)
+
+# KEYS[4]: room:{id}:answer, casefolded
+# ARGV[3]: the id of the user who sent the message, ARGV[4]: the message, casefolded (Lua's
+# string.lower only knows ASCII)
+# returns {verdict, has_guessed, turn complete}, and the answer if the verdict is WRONG
+_EVALUATE_GUESS = (
+    _PUBLISH_IF_COMPLETE
+    + """
+local has_guessed = redis.call('SISMEMBER', KEYS[1], ARGV[3])
+local answer = redis.call('GET', KEYS[4])
+if not answer then
+    return {0, has_guessed, 0}
+end
+if ARGV[4] ~= answer then
+    return {1, has_guessed, 0, answer}
+end
+if has_guessed == 1 then
+    return {3, 1, 0}
+end
+redis.call('SADD', KEYS[1], ARGV[3])
+return {2, 1, publish_if_complete()}
+"""
+)
+
+_check_turn_complete = cache.client.register_script(_CHECK_TURN_COMPLETE)
+_evaluate_guess = cache.client.register_script(_EVALUATE_GUESS)
+
+
+class Verdict(IntEnum):
+    """The outcome of checking a chat message against the current answer."""
+
+    NO_ANSWER = 0  # there is no turn in progress
+    WRONG = 1
+    CORRECT = 2  # the user guessed the answer for the first time this turn
+    REPEATED = 3  # the user already guessed the answer, and sent it again
+    CLOSE = 4  # a wrong guess, but a close one (decided after the script, see is_close)
+
+
+def _keys(room_id: str) -> list[str]:
+    return [f"room:{room_id}:guessed", f"room:{room_id}:members", f"room:{room_id}:turn"]
+
+
+# wrong guesses within a couple of typos of the answer are close, ignoring case, whitespace and
+# punctuation. each answer is indexed once, by its length, its letter counts, and every string
+# reachable from it by deleting up to two characters. two words within edit distance two always
+# share a deletion string, so only a guess that does goes on to an exact, bounded edit distance.
+
+# edits allowed for a close guess, and the answer length from which the most are allowed
+_MAX_EDITS = 2
+_MIN_LENGTH_FOR_MAX_EDITS = 5
+
+
+def _squash(text: str) -> str:
+    return "".join(ch for ch in text.casefold() if ch.isalnum())
+
+
+def _deletions(word: str) -> set[str]:
+    """Every string made by deleting one character from a word."""
+    return {word[:i] + word[i + 1 :] for i in range(len(word))}
+
+
+def _neighborhood(word: str) -> set[str]:
+    """Every string made by deleting up to `_MAX_EDITS` characters from a word."""
+    out = frontier = {word}
+    for _ in range(_MAX_EDITS):
+        frontier = {d for w in frontier for d in _deletions(w)}
+        out |= frontier
+    return out
+
+
+def _shares_deletion(word: str, neighborhood: frozenset[str]) -> bool:
+    """Whether the neighborhoods of a word and an indexed word meet, computed lazily."""
+    if word in neighborhood:
+        return True
+    singles = _deletions(word)
+    if not neighborhood.isdisjoint(singles):
+        return True
+    return any(not neighborhood.isdisjoint(_deletions(w)) for w in singles)
+
+
+def _within(a: str, b: str, limit: int) -> bool:
+    """Whether the Levenshtein distance between two strings is at most `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return False
+        previous = current
+    return previous[-1] <= limit
+
+
+@lru_cache(maxsize=1024)
+def answer_index(answer: str) -> tuple[str, Counter[str], frozenset[str]]:
+    """An answer's squashed form, its letter counts, and its deletion neighborhood.
+
+    Built by the turn engine as it sets the answer, and by other workers on the first
+    wrong guess they see, then cached.
+    """
+    squashed = _squash(answer)
+    return squashed, Counter(squashed), frozenset(_neighborhood(squashed))
+
+
+def is_close(guess: str, answer: str) -> bool:
+    """Whether a wrong guess is within a couple of typos of the answer."""
+    squashed, letters, neighborhood = answer_index(answer)
+    limit = _MAX_EDITS if len(squashed) >= _MIN_LENGTH_FOR_MAX_EDITS else 1
+    guess = _squash(guess)
+    # most chat messages are nowhere near the answer's length
+    if not guess or abs(len(guess) - len(squashed)) > limit:
+        return False
+    # each edit adds or removes at most one letter on either side
+    guess_letters = Counter(guess)
+    if max((guess_letters - letters).total(), (letters - guess_letters).total()) > limit:
+        return False
+    return _shares_deletion(guess, neighborhood) and _within(guess, squashed, limit)
+
+
+def start_signal(room_id: str) -> str:
+    """The notice published on `SIGNALS` when a room's game starts."""
+    return json.dumps({"room_id": room_id, "start": True})
+
+
+async def evaluate_guess(
+    conn: Redis, room_id: str, user_id: str, message: str
+) -> tuple[Verdict, bool]:
+    """Check a chat message against the room's answer in a single round trip.
+
+    Compares case-insensitively, and adds the user to the room's set of correct guessers
+    if they haven't guessed already. Publishes the turn completion notice if this was the
+    last member left to guess. A wrong guess from a user yet to guess the answer may be
+    close, see `is_close`.
+
+    Returns:
+        The verdict, and whether the user has (now) guessed the answer this turn.
+    """
+    verdict, has_guessed, complete, *answer = await typing.cast(
+        typing.Awaitable[list[int | bytes]],
+        _evaluate_guess(
+            [*_keys(room_id), f"room:{room_id}:answer"],
+            [SIGNALS, room_id, user_id, message.casefold()],
+            client=conn,
+        ),
+    )
+    if complete:
+        logger.info(f"Game Loop[room={room_id}]: everyone has guessed")
+    if verdict == Verdict.WRONG and not has_guessed and is_close(message, answer[0].decode()):
+        return Verdict.CLOSE, False
+    return Verdict(verdict), bool(has_guessed)
+
+
+async def check_turn_complete(conn: Redis, room_id: str) -> bool:
+    """Publish the turn completion notice if everyone left in the room has guessed."""
+    res = await typing.cast(
+        typing.Awaitable[int],
+        _check_turn_complete(_keys(room_id), [SIGNALS, room_id], client=conn),
+    )
+    return res == 1
@@ -0,0 +1,193 @@
+"""The bank of words players are asked to draw."""
+import asyncio
+import contextlib
+import heapq
+import os
+import random
+from array import array
+from collections.abc import Collection, Iterable
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from loguru import logger
+
+from quill_server.config import settings
+
+
+# relative word list paths are resolved against the project root, not the working directory
+ROOT = Path(__file__).resolve().parents[2]
+
+
+def normalize(word: str) -> str:
+    """A word as it's shown to players: trimmed, with runs of whitespace collapsed."""
+    return " ".join(word.split())
+
+
+def key(word: str) -> str:
+    """What a word is compared by, when checking for repeats."""
+    return normalize(word).casefold()
+
+
+@dataclass(frozen=True, slots=True)
+class Snapshot:
+    """The word lists as loaded at one point in time.
+
+    Every list belongs to a category, named after its file, and its words sit in one contiguous
+    slice of the tuples. Snapshots are never changed; a reload replaces the whole snapshot.
+    """
+
+    words: tuple[str, ...] = ()
+    keys: tuple[str, ...] = ()
+    weights: array = field(default_factory=lambda: array("d"))
+    # category -> the slices of the tuples holding its words, one per list
+    categories: dict[str, list[range]] = field(default_factory=dict)
+    # whether any weight differs from 1, which makes sampling slower
+    weighted: bool = False
+    # path -> modification time, when read
+    mtimes: dict[Path, float] = field(default_factory=dict)
+
+
+# a list has one word per line, optionally followed by a tab and a weight making the word that
+# much more (or less) likely to come up; blank lines and lines starting with `#` are skipped
+def _parse(path: Path) -> list[tuple[str, float]]:
+    entries = []
+    seen = set[str]()
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, start=1):
+            word, _, weight = line.rstrip("\n").partition("\t")
+            word = normalize(word)
+            if not word or word.startswith("#") or key(word) in seen:
+                continue
+            try:
+                entries.append((word, float(weight) if weight.strip() else 1.0))
+            except ValueError:
+                logger.warning(f"WordBank: {path}:{n}: bad weight {weight!r}; skipping")
+                continue
+            seen.add(key(word))
+    return entries
+
+
+def _load(paths: list[Path]) -> Snapshot:
+    words, keys, weights = [], [], array("d")
+    categories, mtimes = {}, {}
+    for path in paths:
+        mtimes[path] = path.stat().st_mtime
+        entries = _parse(path)
+        start = len(words)
+        for word, weight in entries:
+            words.append(word)
+            keys.append(key(word))
+            weights.append(weight)
+        categories.setdefault(path.stem, []).append(range(start, len(words)))
+    return Snapshot(
+        words=tuple(words),
+        keys=tuple(keys),
+        weights=weights,
+        categories=categories,
+        weighted=any(weight != 1.0 for weight in weights),
+        mtimes=mtimes,
+    )
+
+
+def _mtimes(paths: list[Path]) -> dict[Path, float]:
+    mtimes = {}
+    for path in paths:
+        with contextlib.suppress(OSError):
+            mtimes[path] = os.stat(path).st_mtime
+    return mtimes
+
+
+class WordBank:
+    """Word lists loaded into memory, and sampled from without replacement.
+
+    Args:
+        paths: The word lists; relative paths are taken from the project root.
+        reload_interval: How often the lists are checked for changes, in seconds; 0 never.
+    """
+
+    def __init__(self, paths: Iterable[str], reload_interval: float) -> None:
+        self.paths = [ROOT / path for path in paths]
+        self.reload_interval = reload_interval
+        self.snapshot = Snapshot()
+        self._watcher: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self.snapshot.words)
+
+    async def load(self) -> None:
+        """Read the word lists, and switch to them once they've been read."""
+        # reading and parsing happen in a thread, and the snapshot is swapped in one assignment,
+        # so games never wait on a reload
+        snapshot = await asyncio.to_thread(_load, self.paths)
+        self.snapshot = snapshot
+        logger.info(
+            f"WordBank: loaded {len(snapshot.words)} words in {len(snapshot.categories)} categories"
+        )
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            if await asyncio.to_thread(_mtimes, self.paths) == self.snapshot.mtimes:
+                continue
+            try:
+                await self.load()
+            except (OSError, UnicodeDecodeError) as e:
+                # keep the words we have until the lists are readable again
+                logger.warning(f"WordBank: couldn't reload word lists: {e}")
+
+    async def start(self) -> None:
+        """Load the word lists, and start watching them for changes."""
+        await self.load()
+        if self.reload_interval > 0:
+            self._watcher = asyncio.create_task(self._watch(), name="word-bank")
+
+    async def stop(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+
+    def sample(
+        self,
+        k: int,
+        exclude: Collection[str] = (),
+        categories: Collection[str] | None = None,
+    ) -> list[str]:
+        """Draw `k` distinct words.
+
+        Args:
+            k: The number of words.
+            exclude: Keys (see `key`) of words that shouldn't come up, such as the room's
+                earlier answers. If there aren't `k` other words, excluded ones are drawn too.
+            categories: The categories to draw from; all of them if None.
+
+        Returns:
+            The words, in random order. Fewer than `k` if there aren't that many words.
+        """
+        snapshot = self.snapshot
+        if not snapshot.categories:
+            return []
+        names = snapshot.categories if categories is None else categories
+        ranges = [r for c in names for r in snapshot.categories.get(c, ())]
+        pool = [i for r in ranges for i in r]
+        fresh = [i for i in pool if snapshot.keys[i] not in exclude] if exclude else pool
+        if len(fresh) < k:
+            stale = [i for i in pool if snapshot.keys[i] in exclude]
+            picks = fresh + self._pick(snapshot, stale, k - len(fresh))
+            random.shuffle(picks)
+        else:
+            picks = self._pick(snapshot, fresh, k)
+        return [snapshot.words[i] for i in picks]
+
+    @staticmethod
+    def _pick(snapshot: Snapshot, pool: list[int], k: int) -> list[int]:
+        k = min(k, len(pool))
+        if not snapshot.weighted:
+            return random.sample(pool, k)
+        # weighted sampling without replacement (Efraimidis-Spirakis): each word's key is
+        # u ** (1 / weight) for uniform u, and the k largest keys win
+        weights = snapshot.weights
+        return heapq.nlargest(
+            k, pool, key=lambda i: random.random() ** (1 / weights[i]) if weights[i] > 0 else -1
+        )
+
+
+word_bank = WordBank(settings.WORD_LISTS, settings.WORD_LISTS_RELOAD_INTERVAL)
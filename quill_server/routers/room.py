@@ -1,4 +1,6 @@
 import asyncio
+import contextlib
+import time
 from typing import Annotated
 
 from fastapi import (
@@ -9,46 +11,70 @@ from fastapi import (
     WebSocketException,
     status,
 )
-from sqlalchemy.ext.asyncio import AsyncSession
+from loguru import logger
+from pydantic import ValidationError
 
 from quill_server import cache
 from quill_server.auth import get_current_session_ws, get_current_user, get_current_user_ws
-from quill_server.db.connect import get_db
-from quill_server.db.models import User
-from quill_server.realtime.events import EventType, process_message
-from quill_server.realtime.game_loop import game_loop
+from quill_server.schema import MessageResponse, UserInfo
+from quill_server.realtime.drawing import emit_drawing
+from quill_server.realtime.encoding import SUBPROTOCOLS, Encoding, is_available, receive
+from quill_server.realtime.events import (
+    PERSONAL_EVENTS,
+    Drawing,
+    Event,
+    EventType,
+    ExcalidrawElement,
+    process_message,
+    validate_elements,
+)
+from quill_server.realtime.lifecycle import TOUCH_INTERVAL, touch
+from quill_server.realtime.lobby import reserve_seat
 from quill_server.realtime.pubsub import Broadcaster
-from quill_server.realtime.room import get_current_room, Room
+from quill_server.realtime.ratelimit import RateLimiter
+from quill_server.realtime.room import GameMember, get_current_room, get_room, Room
+from quill_server.realtime.scheduler import scheduler
 
 
 router = APIRouter(prefix="/room", tags=["room"])
 
-_bg_tasks = set()
-
 
 @router.post("/")
-async def create_room(user: Annotated[User, Depends(get_current_user)]) -> Room:
+async def create_room(user: Annotated[UserInfo, Depends(get_current_user)]) -> Room:
     room = Room.new(user)
     await room.to_redis()
-    task = asyncio.create_task(game_loop(cache.client, room.room_id))
-    _bg_tasks.add(task)
-    task.add_done_callback(_bg_tasks.discard)
+    await scheduler.schedule(room.room_id)
     return room
 
 
+@router.post("/quick-join")
+async def quick_join(user: Annotated[UserInfo, Depends(get_current_user)]) -> Room:
+    """Reserve a seat in the fullest room that's waiting for players, or create a room if
+    none has space. The seat is held for ROOM_SEAT_RESERVATION_TTL seconds."""
+    room_id = await reserve_seat(cache.client, str(user.id))
+    # the room may have been deleted just after the seat was reserved
+    if room_id is not None and (room := await get_room(room_id)):
+        return room
+    return await create_room(user)
+
+
 @router.websocket("/{room_id}")
 async def room_socket(
     ws: WebSocket,
-    db: Annotated[AsyncSession, Depends(get_db)],
     room: Annotated[Room | None, Depends(get_current_room)],
 ) -> None:
     if not room:
         raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Room not found")
-    await ws.accept()
+    # the client may ask for an encoding through the websocket subprotocol...
+    subprotocol = next(
+        (p for p in ws.scope["subprotocols"] if is_available(SUBPROTOCOLS.get(p))), None
+    )
+    await ws.accept(subprotocol)
 
     # the first message the user sends will be the authorization
-    # if it is not valid - reject the connection
-    auth_msg: dict[str, str] = await ws.receive_json()
+    # if it is not valid - reject the connection. a client reconnecting after losing its
+    # connection also sends the sequence number of the last event it received
+    auth_msg: dict[str, str | int] = await ws.receive_json()
     token_text = auth_msg.get("Authorization")
     if not token_text:
         raise WebSocketException(status.WS_1008_POLICY_VIOLATION, "Authorization not sent")
@@ -59,27 +85,118 @@ async def room_socket(
         raise WebSocketException(
             status.WS_1008_POLICY_VIOLATION, "Authorization not sent"
         ) from None
-    user = await get_current_user_ws(session, db)
+    user = await get_current_user_ws(session)
+    # ...or in its authorization message
+    try:
+        encoding = Encoding(
+            SUBPROTOCOLS[subprotocol] if subprotocol else auth_msg.get("encoding", "json")
+        )
+    except ValueError:
+        raise WebSocketException(status.WS_1008_POLICY_VIOLATION, "Unknown encoding") from None
+    if not is_available(encoding):
+        raise WebSocketException(status.WS_1008_POLICY_VIOLATION, "Unsupported encoding")
+    last_seq = auth_msg.get("last_seq")
+    # bools are ints too
+    valid_seq = isinstance(last_seq, int) and not isinstance(last_seq, bool) and last_seq >= 0
+    if last_seq is not None and not valid_seq:
+        raise WebSocketException(status.WS_1008_POLICY_VIOLATION, "Invalid last_seq")
 
     try:
-        await room.join(user)  # add the user to list of connected users
+        # add the user to list of connected users
+        await room.join(user, rejoining=last_seq is not None)
     except ValueError as e:
         raise WebSocketException(status.WS_1008_POLICY_VIOLATION, e.args[0]) from None
 
-    broadcaster = Broadcaster(ws, cache.client, user, room)
-    task = asyncio.create_task(broadcaster.listen())
+    broadcaster = Broadcaster(
+        ws,
+        cache.client,
+        user,
+        room,
+        last_seq=last_seq,
+        resuming=last_seq is not None,
+        encoding=encoding,
+    )
+    # CONNECT is sent first; listening then catches up on events logged since
     await broadcaster.join()
+    task = asyncio.create_task(broadcaster.listen())
 
+    member = GameMember(user_id=str(user.id), username=user.username)
+
+    async def release_drawing(elements: list[ExcalidrawElement]) -> None:
+        await emit_drawing(cache.client, room.room_id, Drawing(user=member, elements=elements))
+
+    limiter = RateLimiter(cache.client, room.room_id, release=release_drawing)
+    # joining touched the room
+    touched_at = time.monotonic()
     try:
         while True:
-            data = await ws.receive_json()
-            event = await process_message(data, room, user, cache.client)
-            # error events need not be emitted to everyone
-            if event.event_type == EventType.ERROR:
-                await broadcaster.send_personal(event)
-            else:
-                await broadcaster.emit(event)
+            data = await receive(ws, encoding)
+            if time.monotonic() - touched_at > TOUCH_INTERVAL:
+                touched_at = time.monotonic()
+                await touch(cache.client, room.room_id)
+            event_type = str(data.get("event_type"))
+            frame_data = data.get("data")
+            elements = frame_data.get("elements") if isinstance(frame_data, dict) else None
+            if event_type == EventType.DRAWING:
+                # before they're held back, or merged with the ones that were
+                try:
+                    elements = validate_elements(elements)
+                except ValidationError:
+                    message = MessageResponse(message="Malformed drawing; it was dropped")
+                    await broadcaster.send_personal(
+                        Event[MessageResponse](event_type=EventType.ERROR, data=message)
+                    )
+                    continue
+            if not await limiter.allow(event_type):
+                # drawings are held back and coalesced; anything else is dropped
+                if event_type == EventType.DRAWING:
+                    limiter.hold(elements)
+                elif limiter.should_warn(event_type):
+                    message = MessageResponse(
+                        message=f"Slow down! Some {event_type} events were dropped"
+                    )
+                    await broadcaster.send_personal(
+                        Event[MessageResponse](event_type=EventType.ERROR, data=message)
+                    )
+                continue
+            if event_type == EventType.DRAWING:
+                frame_data["elements"] = limiter.merge_held(elements)
+            for event in await process_message(data, room, user, cache.client):
+                # errors and hints need not be emitted to everyone
+                if event.event_type in PERSONAL_EVENTS:
+                    await broadcaster.send_personal(event)
+                elif event.event_type == EventType.DRAWING:
+                    # coalesced with the drawer's other updates in the same frame window
+                    await emit_drawing(cache.client, room.room_id, event.data)
+                else:
+                    await broadcaster.emit(event)
     except WebSocketDisconnect:
+        pass
+    except Exception:
+        logger.opt(exception=True).error(f"room:{room.room_id}: {user.username}'s socket failed")
+        with contextlib.suppress(RuntimeError):
+            await ws.close(status.WS_1011_INTERNAL_ERROR)
+    finally:
+        limiter.close()
+        # shielded, so that the user is taken out of the room even if the handler is cancelled
+        await asyncio.shield(_leave(room, user, broadcaster, task))
+
+
+async def _leave(
+    room: Room, user: UserInfo, broadcaster: Broadcaster, listener: asyncio.Task
+) -> None:
+    try:
         await room.leave(user)  # remove the user from the list of connected users
         await broadcaster.leave()
-        await task
+        # after MEMBER_LEAVE is logged; the room may have been emptied, or even deleted
+        await touch(cache.client, room.room_id)
+    except Exception:
+        logger.opt(exception=True).error(f"room:{room.room_id}: {user.username} couldn't leave")
+        # the listener stops once it sees the user's MEMBER_LEAVE, which may never come
+        listener.cancel()
+    try:
+        await listener
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        logger.opt(exception=True).error(f"room:{room.room_id}: {user.username}'s listener failed")
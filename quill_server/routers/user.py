@@ -27,14 +27,15 @@ router = APIRouter(prefix="/user", tags=["user"])
 async def signup(
     user: UserSignupBody, session: Annotated[AsyncSession, Depends(get_db)]
 ) -> SuccessfulLoginResponse:
+    hashed = await hash_password(user.password)
     try:
         async with session.begin():
-            db_user = User(username=user.username, password=hash_password(user.password))
+            db_user = User(username=user.username, password=hashed)
             session.add(db_user)
     except IntegrityError as e:
         raise HTTPException(status_code=409, detail="Username is already in use") from e
     logger.info(f"Created new user {user.username}")
-    user_session = await set_session(db_user.id)
+    user_session = await set_session(db_user.id, db_user.username)
     return SuccessfulLoginResponse(username=db_user.username, **user_session.model_dump())
 
 
@@ -55,13 +56,13 @@ async def login(
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    if not verify_password(plaintext, user.password):
+    if not await verify_password(plaintext, user.password):
         raise HTTPException(
             status_code=401,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    session = await set_session(user.id)
+    session = await set_session(user.id, user.username)
     return SuccessfulLoginResponse(username=username, **session.model_dump())
 
 
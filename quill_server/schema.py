@@ -1,4 +1,6 @@
 """Pydantic models for request and response validation."""
+from uuid import UUID
+
 from pydantic import BaseModel
 
 
@@ -20,3 +22,10 @@ class SuccessfulLoginResponse(BaseModel):
     username: str
     access_token: str
     token_type: str
+
+
+class UserInfo(BaseModel):
+    """The details of an authenticated user, detached from any database session."""
+
+    id: UUID  # noqa: A003
+    username: str
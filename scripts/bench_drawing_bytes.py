@@ -0,0 +1,108 @@
+"""Compare the bytes published per turn by full-canvas forwarding and delta drawing sync.
+
+    poetry run python scripts/bench_drawing_bytes.py --strokes 40 --points 60
+"""
+import random
+import uuid
+from argparse import ArgumentParser
+
+from quill_server.realtime.canvas import Canvas
+from quill_server.realtime.events import Drawing, DrawingEvent, ExcalidrawElement
+from quill_server.realtime.room import GameMember
+
+
+parser = ArgumentParser("Quill drawing bandwidth benchmark")
+parser.add_argument("--strokes", type=int, default=40, help="freehand strokes per turn")
+parser.add_argument("--points", type=int, default=60, help="pointer moves per stroke")
+parser.add_argument("--members", type=int, default=8, help="players receiving each event")
+
+args = parser.parse_args()
+
+
+def new_stroke() -> ExcalidrawElement:
+    return {
+        "id": uuid.uuid4().hex[:20],
+        "type": "freedraw",
+        "x": random.uniform(0, 800),
+        "y": random.uniform(0, 600),
+        "width": 0,
+        "height": 0,
+        "angle": 0,
+        "strokeColor": "#1e1e1e",
+        "backgroundColor": "transparent",
+        "fillStyle": "hachure",
+        "strokeWidth": 1,
+        "strokeStyle": "solid",
+        "roughness": 1,
+        "opacity": 100,
+        "groupIds": [],
+        "frameId": None,
+        "roundness": None,
+        "seed": random.randrange(2**31),
+        "version": 1,
+        "versionNonce": random.randrange(2**31),
+        "isDeleted": False,
+        "boundElements": None,
+        "updated": 0,
+        "link": None,
+        "locked": False,
+        "points": [[0, 0]],
+        "pressures": [],
+        "simulatePressure": True,
+        "lastCommittedPoint": None,
+    }
+
+
+def extend(stroke: ExcalidrawElement) -> ExcalidrawElement:
+    x, y = stroke["points"][-1]
+    point = [x + random.uniform(-4, 4), y + random.uniform(-4, 4)]
+    return stroke | {
+        "points": [*stroke["points"], point],
+        "version": stroke["version"] + 1,
+        "versionNonce": random.randrange(2**31),
+    }
+
+
+def client_updates() -> list[list[ExcalidrawElement]]:
+    """Every update the drawer's client sends during a turn.
+
+    Excalidraw reports every element on the canvas each time the pointer moves.
+    """
+    elements: list[ExcalidrawElement] = []
+    updates = []
+    for _ in range(args.strokes):
+        elements.append(new_stroke())
+        for _ in range(args.points):
+            elements[-1] = extend(elements[-1])
+            updates.append(list(elements))
+    return updates
+
+
+def event_size(user: GameMember, elements: list[ExcalidrawElement]) -> int:
+    return len(DrawingEvent(data=Drawing(user=user, elements=elements)).model_dump_json())
+
+
+def report(name: str, events: int, size: int) -> None:
+    print(f"{name}:")
+    print(f"  events:    {events}")
+    print(f"  published: {size / 1024:.1f} KiB")
+    print(f"  sent:      {size * args.members / 1024:.1f} KiB to {args.members} members")
+
+
+def main() -> None:
+    random.seed(0)
+    user = GameMember(user_id=str(uuid.uuid4()), username="drawer")
+    updates = client_updates()
+
+    full = sum(event_size(user, elements) for elements in updates)
+    report("full canvas forwarding", len(updates), full)
+
+    canvas = Canvas()
+    deltas = [changed for elements in updates if (changed := canvas.apply(elements))]
+    delta = sum(event_size(user, elements) for elements in deltas)
+    report("delta sync", len(deltas), delta)
+
+    print(f"delta sync publishes {delta / full:.1%} of the bytes of full forwarding")
+
+
+main()
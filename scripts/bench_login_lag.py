@@ -0,0 +1,68 @@
+"""Measure event loop lag while many logins are being verified at once.
+
+    poetry run python scripts/bench_login_lag.py --logins 50
+"""
+import asyncio
+import statistics
+import time
+from argparse import ArgumentParser
+from collections.abc import Awaitable, Callable
+
+from quill_server.auth.hashing import HasherBusyError, PasswordHasher, _hash, _verify
+
+
+parser = ArgumentParser("Quill login event loop lag benchmark")
+parser.add_argument("--logins", type=int, default=50)
+parser.add_argument("--workers", type=int, default=2)
+parser.add_argument("--max-pending", type=int, default=32)
+parser.add_argument("--interval", type=float, default=0.005, help="probe interval, in seconds")
+
+args = parser.parse_args()
+
+
+# how late the event loop wakes this up is how late every websocket on it is served
+async def probe(lags: list[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(args.interval)
+        lags.append(time.perf_counter() - start - args.interval)
+
+
+async def measure(name: str, login: Callable[[], Awaitable[bool]]) -> None:
+    lags: list[float] = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    await asyncio.sleep(args.interval * 2)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(login() for _ in range(args.logins)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+
+    rejected = sum(isinstance(r, HasherBusyError) for r in results)
+    lags.sort()
+    print(f"{name}:")
+    print(f"  logins:    {args.logins} in {elapsed:.2f}s ({rejected} rejected as busy)")
+    print(f"  lag p50:   {statistics.median(lags) * 1000:.2f}ms")
+    print(f"  lag p99:   {lags[int(len(lags) * 0.99)] * 1000:.2f}ms")
+    print(f"  lag max:   {lags[-1] * 1000:.2f}ms")
+
+
+async def main() -> None:
+    hashed = _hash("hunter2")
+
+    async def inline() -> bool:
+        return _verify("hunter2", hashed)
+
+    hasher = PasswordHasher(args.workers, args.max_pending)
+
+    async def pooled() -> bool:
+        return await hasher.verify("hunter2", hashed)
+
+    await measure("inline", inline)
+    await measure(f"pool (workers={args.workers}, max_pending={args.max_pending})", pooled)
+    hasher.shutdown()
+
+
+asyncio.run(main())
@@ -0,0 +1,187 @@
+"""Compare the turn engine with a coroutine per room, for many concurrent games.
+
+Run each model in its own process, so that their memory use doesn't overlap:
+
+    poetry run python scripts/bench_turn_engine.py --model engine --games 10000
+    poetry run python scripts/bench_turn_engine.py --model coroutines --games 10000
+"""
+import asyncio
+import contextlib
+import math
+import resource
+import time
+import typing
+from argparse import ArgumentParser
+from uuid import uuid4
+
+from loguru import logger
+
+from quill_server import cache
+from quill_server.realtime.canvas import snapshot_key
+from quill_server.realtime.events import Event, EventType
+from quill_server.realtime.game_loop import TurnEngine
+from quill_server.realtime.pubsub import hub, publish
+from quill_server.realtime.room import GameMember, TurnEndData, TurnStartData, get_members
+from quill_server.realtime.turn import check_turn_complete
+from quill_server.realtime.words import word_bank
+
+
+parser = ArgumentParser("Quill turn engine benchmark")
+parser.add_argument("--model", choices=["engine", "coroutines"], default="engine")
+parser.add_argument("--games", type=int, default=1000)
+parser.add_argument("--members", type=int, default=4, help="members per room")
+parser.add_argument("--turn-seconds", type=float, default=20.0)
+parser.add_argument("--cooldown", type=float, default=2.0)
+parser.add_argument("--warmup", type=float, default=3.0, help="seconds before sampling")
+parser.add_argument("--seconds", type=float, default=30.0, help="seconds to sample for")
+
+args = parser.parse_args()
+
+# enough rounds that no game ends while sampling
+ROUNDS = (
+    math.ceil((args.warmup + args.seconds) / (args.turn_seconds + args.cooldown) / args.members) + 1
+)
+KEYS = [
+    "status",
+    "members",
+    "order",
+    "answer",
+    "guessed",
+    "turn",
+    "progress",
+    "seq",
+    "log",
+    "words",
+]
+
+
+async def per_room_game(room_id: str) -> None:
+    """A game played the way the game loop played it before the turn engine.
+
+    Nobody guesses, so every turn times out.
+    """
+    conn = cache.client
+    async with hub.subscribe_room(room_id), hub.subscribe(f"room:{room_id}:turns") as notices:
+        for i in range(ROUNDS):
+            for idx, user in enumerate(await get_members(conn, room_id)):
+                connected = await typing.cast(
+                    typing.Awaitable[bool], conn.hexists(f"room:{room_id}:members", user.user_id)
+                )
+                if not connected:
+                    continue
+                answer = word_bank.sample(1)[0]
+                await conn.set(f"room:{room_id}:answer", answer)
+                await conn.delete(snapshot_key(room_id))
+                await typing.cast(
+                    typing.Awaitable[int], conn.sadd(f"room:{room_id}:guessed", user.user_id)
+                )
+                turn_id = f"{i}:{idx}"
+                await conn.mset(
+                    {f"room:{room_id}:turn": turn_id, f"room:{room_id}:progress": turn_id}
+                )
+                start_data = TurnStartData(user=user, answer=answer)
+                await publish(
+                    conn,
+                    room_id,
+                    Event[TurnStartData](event_type=EventType.TURN_START, data=start_data),
+                )
+                await check_turn_complete(conn, room_id)
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(notices.__anext__(), timeout=args.turn_seconds)
+                await conn.delete(
+                    f"room:{room_id}:guessed", f"room:{room_id}:turn", snapshot_key(room_id)
+                )
+                end_event = Event[TurnEndData](
+                    event_type=EventType.TURN_END, data=TurnEndData(turn=idx)
+                )
+                await publish(conn, room_id, end_event)
+                await asyncio.sleep(args.cooldown)
+
+
+async def create_rooms() -> list[str]:
+    rooms = [f"bench-{uuid4()}" for _ in range(args.games)]
+    async with cache.client.pipeline(transaction=False) as pipe:
+        for room_id in rooms:
+            members = [
+                GameMember(user_id=str(uuid4()), username=f"u{i}") for i in range(args.members)
+            ]
+            pipe.set(f"room:{room_id}:status", "ongoing")
+            pipe.hset(f"room:{room_id}:members", mapping={m.user_id: m.username for m in members})
+            pipe.zadd(f"room:{room_id}:order", {m.user_id: i for i, m in enumerate(members)})
+        await pipe.execute()
+    return rooms
+
+
+async def events_logged(rooms: list[str]) -> int:
+    async with cache.client.pipeline(transaction=False) as pipe:
+        for room_id in rooms:
+            pipe.get(f"room:{room_id}:seq")
+        return sum(int(seq or 0) for seq in await pipe.execute())
+
+
+async def delete_rooms(rooms: list[str]) -> None:
+    async with cache.client.pipeline(transaction=False) as pipe:
+        for room_id in rooms:
+            pipe.delete(*(f"room:{room_id}:{key}" for key in KEYS), snapshot_key(room_id))
+        await pipe.execute()
+
+
+def rss_kib() -> int:
+    # the resident set size right now, rather than the peak getrusage reports (Linux only)
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+
+async def main() -> None:
+    # the engine logs every turn, and this copy of the old loop doesn't
+    logger.remove()
+    await word_bank.load()
+    rooms = await create_rooms()
+    # start the hub's connection and reader outside of the measurements
+    async with hub.subscribe(f"bench-{uuid4()}"):
+        pass
+    rss_before = rss_kib()
+
+    engine = TurnEngine(
+        cache.client,
+        n_rounds=ROUNDS,
+        turn_seconds=args.turn_seconds,
+        cooldown_seconds=args.cooldown,
+    )
+    tasks = []
+    if args.model == "engine":
+        await engine.start()
+        for room_id in rooms:
+            engine.add(room_id)
+    else:
+        tasks = [asyncio.create_task(per_room_game(room_id)) for room_id in rooms]
+
+    await asyncio.sleep(args.warmup)
+    rss_after = rss_kib()
+    n_tasks = len(asyncio.all_tasks())
+    events_start = await events_logged(rooms)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    await asyncio.sleep(args.seconds)
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    turns = (await events_logged(rooms) - events_start) / 2
+
+    await engine.stop()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await delete_rooms(rooms)
+    await hub.aclose()
+    await cache.disconnect()
+
+    print(f"model:             {args.model}")
+    print(f"games:             {args.games} of {args.members} members")
+    print(f"tasks:             {n_tasks}")
+    print(f"memory:            {(rss_after - rss_before) / 1024:.1f} MiB")
+    print(f"memory per game:   {(rss_after - rss_before) / args.games:.2f} KiB")
+    print(f"turns played:      {turns:.0f} in {wall:.2f}s")
+    print(f"cpu time:          {cpu:.2f}s ({cpu / wall:.2%} of one core)")
+    print(f"cpu per game/sec:  {cpu / wall / args.games * 1e6:.1f}us")
+    print(f"cpu per turn:      {cpu / max(turns, 1) * 1e6:.0f}us")
+
+
+asyncio.run(main())
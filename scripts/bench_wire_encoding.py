@@ -0,0 +1,90 @@
+"""Compare JSON and MessagePack for encoding realistic DRAWING events.
+
+    poetry run python scripts/bench_wire_encoding.py --elements 20 --points 80
+"""
+import random
+import time
+import uuid
+from argparse import ArgumentParser
+from collections.abc import Callable
+
+from quill_server.realtime.encoding import Encoding, dump_model, is_available, loads
+from quill_server.realtime.events import Drawing, DrawingEvent, ExcalidrawElement
+from quill_server.realtime.room import GameMember
+
+
+parser = ArgumentParser("Quill wire encoding benchmark")
+parser.add_argument("--elements", type=int, default=20, help="strokes per event")
+parser.add_argument("--points", type=int, default=80, help="points per stroke")
+parser.add_argument("--runs", type=int, default=2000)
+
+args = parser.parse_args()
+
+
+def stroke() -> ExcalidrawElement:
+    x, y = random.uniform(0, 800), random.uniform(0, 600)
+    points = [[0.0, 0.0]]
+    for _ in range(args.points - 1):
+        px, py = points[-1]
+        points.append([px + random.uniform(-4, 4), py + random.uniform(-4, 4)])
+    return {
+        "id": uuid.uuid4().hex[:20],
+        "type": "freedraw",
+        "x": x,
+        "y": y,
+        "width": 120.5,
+        "height": 80.25,
+        "angle": 0,
+        "strokeColor": "#1e1e1e",
+        "backgroundColor": "transparent",
+        "fillStyle": "hachure",
+        "strokeWidth": 1,
+        "strokeStyle": "solid",
+        "roughness": 1,
+        "opacity": 100,
+        "groupIds": [],
+        "frameId": None,
+        "roundness": None,
+        "seed": random.randrange(2**31),
+        "version": random.randrange(1, 200),
+        "versionNonce": random.randrange(2**31),
+        "isDeleted": False,
+        "boundElements": None,
+        "updated": int(time.time() * 1000),
+        "link": None,
+        "locked": False,
+        "points": points,
+        "pressures": [],
+        "simulatePressure": True,
+        "lastCommittedPoint": None,
+    }
+
+
+def timed(fn: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        fn()
+    return (time.perf_counter() - start) / args.runs
+
+
+def main() -> None:
+    random.seed(0)
+    user = GameMember(user_id=str(uuid.uuid4()), username="drawer")
+    elements = [stroke() for _ in range(args.elements)]
+    event = DrawingEvent(data=Drawing(user=user, elements=elements))
+
+    print(f"DRAWING event with {args.elements} strokes of {args.points} points")
+    for encoding in Encoding:
+        if not is_available(encoding):
+            print(f"{encoding}: unavailable (install msgpack)")
+            continue
+        frame = dump_model(event, encoding)
+        encode = timed(lambda encoding=encoding: dump_model(event, encoding))
+        decode = timed(lambda encoding=encoding, frame=frame: loads(frame, encoding))
+        print(f"{encoding}:")
+        print(f"  size:      {len(frame) / 1024:.1f} KiB")
+        print(f"  encode:    {encode * 1e6:.0f}us")
+        print(f"  decode:    {decode * 1e6:.0f}us")
+
+
+main()
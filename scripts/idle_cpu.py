@@ -0,0 +1,40 @@
+"""Measure the CPU used by idle rooms.
+
+    poetry run python scripts/idle_cpu.py --rooms 1000 --seconds 10
+"""
+import asyncio
+import contextlib
+import time
+from argparse import ArgumentParser
+from uuid import uuid4
+
+from quill_server import cache
+from quill_server.realtime.pubsub import hub
+
+
+parser = ArgumentParser("Quill idle room CPU benchmark")
+parser.add_argument("--rooms", type=int, default=100)
+parser.add_argument("--seconds", type=float, default=10.0)
+
+args = parser.parse_args()
+
+
+async def main() -> None:
+    async with contextlib.AsyncExitStack() as stack:
+        for _ in range(args.rooms):
+            await stack.enter_async_context(hub.subscribe_room(str(uuid4())))
+        # let the subscribe confirmations settle before sampling
+        await asyncio.sleep(1)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        await asyncio.sleep(args.seconds)
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    await hub.aclose()
+    await cache.disconnect()
+
+    print(f"rooms:             {args.rooms}")
+    print(f"wall time:         {wall:.2f}s")
+    print(f"cpu time:          {cpu * 1000:.2f}ms ({cpu / wall:.2%} of one core)")
+    print(f"cpu per room/sec:  {cpu / wall / args.rooms * 1e6:.2f}us")
+
+
+asyncio.run(main())
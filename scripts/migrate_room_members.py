@@ -0,0 +1,21 @@
+"""Move the members of every room in Redis from the legacy list layout to the members hash.
+
+    poetry run python scripts/migrate_room_members.py
+"""
+import asyncio
+
+from quill_server import cache
+from quill_server.realtime.room import migrate_members
+
+
+async def main() -> None:
+    rooms = members = 0
+    async for key in cache.client.scan_iter(match="room:*:users", count=1000):
+        room_id = key.decode().removeprefix("room:").removesuffix(":users")
+        members += await migrate_members(room_id)
+        rooms += 1
+    await cache.disconnect()
+    print(f"Migrated {members} members across {rooms} rooms")
+
+
+asyncio.run(main())
@@ -10,20 +10,30 @@ from loguru import logger
 parser = ArgumentParser("Quill CLI Client")
 parser.add_argument("--host", default="127.0.0.1:8000")
 parser.add_argument("-t", "--token")
+parser.add_argument(
+    "--msgpack", action="store_true", help="ask for MessagePack frames (needs msgpack installed)"
+)
 parser.add_argument("room")
 
 args = parser.parse_args()
 
+if args.msgpack:
+    import msgpack
+
 
 async def ws_connect() -> None:
     print("ws://" + args.host + f"/room/{args.room}")
     async with websockets.connect(
         "ws://" + args.host + f"/room/{args.room}",
+        subprotocols=["quill.msgpack"] if args.msgpack else None,
     ) as ws:
+        # the authorization message is always JSON
         await ws.send(json.dumps({"Authorization": f"Bearer {args.token}"}))
         loop = asyncio.get_running_loop()
         loop.add_signal_handler(signal.SIGINT, loop.create_task, ws.close())
         async for message in ws:
+            if isinstance(message, bytes):
+                message = msgpack.unpackb(message)
             logger.info(message)
 
 
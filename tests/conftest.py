@@ -0,0 +1,6 @@
+import os
+
+
+# settings are read when quill_server is imported; the tests here don't connect to either
+os.environ.setdefault("DATABASE_URL", "postgresql+asyncpg://quill@localhost/quill")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
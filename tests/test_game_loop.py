@@ -0,0 +1,57 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+from redis.exceptions import ConnectionError
+
+from quill_server import cache
+from quill_server.realtime import game_loop
+from quill_server.realtime.game_loop import TurnEngine
+from quill_server.realtime.pubsub import hub
+from quill_server.realtime.room import Room
+from quill_server.realtime.words import word_bank
+from quill_server.schema import UserInfo
+
+
+async def _play_alone(monkeypatch: pytest.MonkeyPatch) -> bool | None:
+    try:
+        await cache.client.ping()
+    except ConnectionError:
+        return None
+    # the completion notice a lone drawer's turn publishes reaches the engine while the step
+    # starting the turn is still in flight, so that the step ends the turn right away
+    check_turn_complete = game_loop.check_turn_complete
+
+    async def check_then_wait(conn: object, room_id: str) -> bool:
+        complete = await check_turn_complete(conn, room_id)
+        await asyncio.sleep(0.2)
+        return complete
+
+    monkeypatch.setattr(game_loop, "check_turn_complete", check_then_wait)
+    await word_bank.load()
+    user = UserInfo(id=uuid4(), username="alone")
+    room = Room.new(user)
+    await room.to_redis()
+    await room.join(user)
+    await room.start()
+
+    finished = asyncio.Event()
+    engine = TurnEngine(cache.client, turn_seconds=30, cooldown_seconds=0)
+    engine.on_finished = lambda room_id, done: finished.set()
+    await engine.start()
+    engine.add(room.room_id)
+    try:
+        await asyncio.wait_for(finished.wait(), timeout=5)
+        return True
+    except TimeoutError:
+        return False
+    finally:
+        await engine.stop()
+        await hub.aclose()
+
+
+def test_lone_drawer_turn_ends(monkeypatch: pytest.MonkeyPatch) -> None:
+    finished = asyncio.run(_play_alone(monkeypatch))
+    if finished is None:
+        pytest.skip("needs Redis at REDIS_URL")
+    assert finished, "the game never got past its first turn"
@@ -0,0 +1,55 @@
+import random
+
+from quill_server.realtime.turn import is_close
+
+
+def _levenshtein(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def _reference(guess: str, answer: str) -> bool:
+    guess = "".join(ch for ch in guess.casefold() if ch.isalnum())
+    answer = "".join(ch for ch in answer.casefold() if ch.isalnum())
+    limit = 2 if len(answer) >= 5 else 1
+    return bool(guess) and _levenshtein(guess, answer) <= limit
+
+
+# a small alphabet, so that random strings often come close to each other
+_LETTERS = "abcdeAB"
+_NOISE = " -'1"
+
+
+def _word(rng: random.Random, length: int) -> str:
+    return "".join(
+        rng.choice(_LETTERS + _NOISE if rng.random() < 0.1 else _LETTERS) for _ in range(length)
+    )
+
+
+def _typo(rng: random.Random, word: str) -> str:
+    for _ in range(rng.randint(0, 3)):
+        i = rng.randint(0, len(word))
+        match rng.randrange(3):
+            case 0:
+                word = word[:i] + rng.choice(_LETTERS) + word[i:]
+            case 1:
+                word = word[:i] + word[i + 1 :]
+            case 2:
+                word = word[:i] + rng.choice(_LETTERS) + word[i + 1 :]
+    return word
+
+
+def test_is_close_matches_levenshtein() -> None:
+    rng = random.Random(2023)
+    mismatches = []
+    for _ in range(50_000):
+        answer = _word(rng, rng.randint(0, 10))
+        guess = _typo(rng, answer) if rng.random() < 0.8 else _word(rng, rng.randint(0, 10))
+        if is_close(guess, answer) != _reference(guess, answer):
+            mismatches.append((guess, answer))
+    assert not mismatches[:10]